@@ -1,51 +1,251 @@
+import os
+import gzip
 import json
-from helper import world, cases, country, news
-from linebot import LineBotApi, WebhookHandler
-from flask import (Flask, abort, request, send_file, render_template, Markup)
+import time
+import hashlib
+import queue
+import pstats
+import random
+import sqlite3
+import cProfile
+import threading
+from concurrent.futures.process import BrokenProcessPool
+try:
+    import brotli
+except ImportError:  # optional, gzip only
+    brotli = None
+from helper import (world, cases, country, news, refresher, iso3Codes,
+                    versionedCache, fileVersion, snapshotVersion, seriesVersion,
+                    loadCountryIndex, loadFacilities, subscribers, CASES_PAGE_SIZE,
+                    FACILITY_RADIUS)
+from linebot import LineBotApi, WebhookParser
+from instrument import metrics
+from flask import (Flask, abort, request, send_file, render_template, Markup,
+                   Response, g, jsonify, url_for)
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import (MessageEvent, TextMessage, TextSendMessage,
                             ImageSendMessage, QuickReply, LocationMessage,
-                            LocationAction, QuickReplyButton, FlexSendMessage)
+                            LocationAction, QuickReplyButton, FlexSendMessage,
+                            FollowEvent, UnfollowEvent)
 
 
 app = Flask(__name__)
 
-with open("keys/channel_access_token.txt", "r") as file:
-    channel_access_token = file.read()
-with open("keys/channel_secret.txt", "r") as file:
-    channel_secret = file.read()
+line_bot_api = None
+webhookParser = None
 
-line_bot_api = LineBotApi(channel_access_token)
-handler = WebhookHandler(channel_secret)
+
+def lineClients():
+    # keys are read on the first webhook, not at import
+    global line_bot_api, webhookParser
+
+    if webhookParser is None:
+        with open("keys/channel_access_token.txt", "r") as file:
+            channel_access_token = file.read()
+        with open("keys/channel_secret.txt", "r") as file:
+            channel_secret = file.read()
+
+        # LINE_API_ENDPOINT points the bot at a local stand-in of the API
+        line_bot_api = LineBotApi(channel_access_token,
+                                  endpoint=os.environ.get('LINE_API_ENDPOINT', 'https://api.line.me'))
+        webhookParser = WebhookParser(channel_secret)
+
+
+# pre-fetch every snapshot in the background, requests only read them
+if os.environ.get('SCHEDULER', '1') != '0':
+    refresher.start()
+
+# draw country charts in the browser, CLIENT_CHARTS=0 embeds a matplotlib PNG
+CLIENT_CHARTS = os.environ.get('CLIENT_CHARTS', '1') != '0'
+
+# pages rendered by generate.py for a static host, no query strings there
+STATIC_SITE = False
+
+# fraction of requests to run under cProfile, 0 turns profiling off
+PROFILE_SAMPLE = float(os.environ.get('PROFILE_SAMPLE', 0))
+profileLock = threading.Lock()
+
+
+@app.before_request
+def startTimer():
+    g.start = time.perf_counter()
+
+    # one profiled request at a time, cProfile can't nest
+    if PROFILE_SAMPLE and random.random() < PROFILE_SAMPLE and profileLock.acquire(blocking=False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def stopTimer(response):
+    route = request.url_rule.rule if request.url_rule else 'unknown'
+    metrics.observe('route_seconds', time.perf_counter() - g.start, route=route)
+    metrics.inc('responses_total', route=route, status=response.status_code)
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profileLock.release()
+
+        os.makedirs('files/profiles', exist_ok=True)
+        profiler.dump_stats('files/profiles/{}-{}.prof'.format(
+            int(time.time() * 1000), request.endpoint))
+        stats = pstats.Stats(profiler).sort_stats('cumulative')
+        app.logger.info("Profiled {}: {:.1f} ms over {} calls".format(
+            request.path, stats.total_tt * 1000, stats.total_calls))
+
+    return response
+
+
+@app.teardown_request
+def countErrors(exc):
+    if exc is not None:
+        metrics.inc('errors_total', where='route')
+
+    # release the profiler if the request blew up before after_request
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profileLock.release()
+
+
+@app.route('/metrics')
+def metricsPage():
+    # numbers of this worker only, each gunicorn process keeps its own
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# encodings we can send, best first
+ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+class renderedPage:
+    # a rendered page with its compressed bodies, every encoding for cached
+    # pages, only the one asked for on a one-off page, and a strong ETag for
+    # each of them since they are different bytes
+
+    def __init__(self, html, encodings=ENCODINGS, fast=False):
+        body = html.encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        self.bodies = {'identity': body}
+        if 'gzip' in encodings:
+            self.bodies['gzip'] = gzip.compress(body, 1 if fast else 6)
+        if 'br' in encodings:
+            # past 5 brotli gets much slower for a few percent
+            self.bodies['br'] = brotli.compress(body, quality=1 if fast else 5)
+        self.etags = {encoding: etag if encoding == 'identity' else etag + '-' + encoding
+                      for encoding in self.bodies}
+
+
+# rendered pages, rebuilt when their snapshots change
+pages = versionedCache()
+
+
+def sendPage(page):
+    encoding = request.accept_encodings.best_match(
+        [e for e in ['br', 'gzip'] if e in page.bodies]) or 'identity'
+
+    # any encoding of the same page is still good, answer with the tag the client has
+    cached = [e for e, etag in page.etags.items() if request.if_none_match.contains_weak(etag)]
+    if cached:
+        response = Response(status=304)
+        encoding = encoding if encoding in cached else cached[0]
+    else:
+        response = Response(page.bodies[encoding], mimetype='text/html')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(page.etags[encoding])
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate, 304 is cheap
+    return response
 
 
 @app.route('/')
 def mainPage():
-    w = world()
-    worldPlot = Markup(w.getWorldMapHTML())
-    worldRank = Markup(w.getWorldHTML())
-    return render_template('world.html', worldPlot=worldPlot, worldRank=worldRank)
+    def render():
+        w = world()
+        worldPlot = Markup(w.getWorldMapHTML())
+        worldRank = Markup(w.getWorldHTML())
+        return renderedPage(render_template('world.html', worldPlot=worldPlot, worldRank=worldRank))
+
+    return sendPage(pages.get('main', snapshotVersion('world'), render))
 
 
 @app.route('/world')
 def worldPage():
-    w = world()
-    worldPlot = Markup(w.getWorldMapHTML())
-    worldRank = Markup(w.getWorldHTML())
-    total = w.getWorldTotal()
+    def render():
+        w = world()
+        worldPlot = Markup(w.getWorldMapHTML())
+        worldRank = Markup(w.getWorldHTML())
+        total = w.getWorldTotal()
+        changes = w.getWorldChanges()
+        movers = Markup(w.getMoversHTML())
+
+        return renderedPage(render_template('world.html', worldPlot=worldPlot, worldRank=worldRank,
+                                            totalConfirmed=total['Confirmed'], totalRecovered=total['Recovered'],
+                                            totalDeath=total['Death'], movers=movers,
+                                            totalNew=changes.total() if changes else None))
+
+    return sendPage(pages.get('world', snapshotVersion('world'), render))
+
+
+def casesQuery():
+    # page, size and filters of /cases and /api/cases
+    page = max(request.args.get('page', 1, type=int), 1)
+    size = min(max(request.args.get('size', CASES_PAGE_SIZE, type=int), 1), 500)
+    filters = {field: request.args.get(field.lower(), '') for field in ['Origin', 'Type', 'Job']}
 
-    return render_template('world.html', worldPlot=worldPlot, worldRank=worldRank, totalConfirmed=total['Confirmed'],
-                           totalRecovered=total['Recovered'], totalDeath=total['Death'])
+    return page, size, {field: value for field, value in filters.items() if value}
+
+
+def casesPageURL(page, size, filters, current):
+    if STATIC_SITE:
+        # cases/ and cases/<page>/, relative so the site can live under any path
+        target = '' if page == 1 else '{}/'.format(page)
+        return (target or './') if current == 1 else '../' + target
+
+    return url_for('casesPage', page=page, size=size, **filters)
 
 
 @app.route('/cases')
 def casesPage():
-    c = cases()
-    casesRank = Markup(c.getCasesHTML())
-    data = c.getCasesSummary()
+    page, size, filters = casesQuery()
+
+    def render(encodings=ENCODINGS, fast=False):
+        c = cases()
+        casesRank = Markup(c.getCasesHTML(page, size, filters))
+        _, total = c.getCasesPage(page, size, filters)
+        data = c.getCasesSummary()
+        pageCount = max((total + size - 1) // size, 1)
+        lowered = {field.lower(): value for field, value in filters.items()}
+
+        return renderedPage(render_template('cases.html', casesRank=casesRank, confirmed=data['confirmed'],
+                                            death=data['death'], recovered=data['recovered'], added=data['added'],
+                                            page=page, pages=pageCount, filters=lowered, search=not STATIC_SITE,
+                                            prevURL=casesPageURL(page - 1, size, lowered, page) if page > 1 else None,
+                                            nextURL=casesPageURL(page + 1, size, lowered, page) if page < pageCount else None),
+                            encodings, fast)
+
+    # only the default page is kept, any other page renders in constant time
+    if page == 1 and size == CASES_PAGE_SIZE and not filters:
+        version = (snapshotVersion('cases'), snapshotVersion('constants'))
+        return sendPage(pages.get('cases', version, render))
+
+    # sent once, compress it quickly and only for this client
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    return sendPage(render([encoding] if encoding else [], fast=True))
 
-    return render_template('cases.html', casesRank=casesRank, confirmed=data['confirmed'], death=data['death'],
-                           recovered=data['recovered'], added=data['added'])
+
+@app.route('/api/cases')
+def casesAPI():
+    page, size, filters = casesQuery()
+    rows, total = cases().getCasesPage(page, size, filters)
+
+    response = jsonify(page=page, size=size, total=total,
+                       pages=max((total + size - 1) // size, 1), cases=rows)
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    return response
 
 
 @app.route('/country/<name>')
@@ -53,16 +253,101 @@ def countryPage(name):
     c = country()
     name = name.replace('-', ' ')
 
-    emojiName = c.getEmojiName(name)
+    # one cached page per country, whatever spelling the url used
+    key = loadCountryIndex().resolve(name)
+    if key is None:
+        return "ไม่พบประเทศนี้ {}".format(name)
 
-    try:
-        countryPlot = c.getCountryPlot(name)
+    def render():
+        emojiName = c.getEmojiName(name)
         countryData = c.getCountryData(name)
+        changes = c.getCountryChanges(name)
+        # the browser draws the chart from the series api unless told otherwise
+        countryPlot = None if CLIENT_CHARTS else c.getCountryPlot(name)
 
-        return render_template('country.html', confirmed=countryData[0], death=countryData[2],
-                               recovered=countryData[1], countryPlot=countryPlot, name=emojiName)
-    except KeyError or Exception:
+        return renderedPage(render_template('country.html', confirmed=countryData[0], death=countryData[2],
+                                            recovered=countryData[1], changes=changes,
+                                            countryPlot=countryPlot, name=emojiName,
+                                            seriesURL=url_for('countrySeriesAPI', name=key)))
+
+    version = (snapshotVersion('world'), seriesVersion(),
+               fileVersion('permanentfiles/country.json'))
+    try:
+        return sendPage(pages.get('country:' + key, version, render))
+    except KeyError:
         return "ไม่พบประเทศนี้ {}".format(name)
+    except (TimeoutError, BrokenProcessPool):  # render pool busy, stuck or crashed
+        abort(503)
+
+
+@app.route('/api/country/<name>/series')
+def countrySeriesAPI(name):
+    points = request.args.get('points', type=int)
+    if points is not None and points < 1:
+        abort(400)
+
+    try:
+        series = country().getCountrySeries(name.replace('-', ' '), points)
+    except KeyError:
+        abort(404)
+
+    # the series changes at most once per refresh, let clients and CDNs keep it
+    response = jsonify(series)
+    response.set_etag('{}-{}-{}'.format(series['country'], seriesVersion(), points))
+    response.headers['Cache-Control'] = 'public, max-age=3600, stale-while-revalidate=86400'
+    return response.make_conditional(request)
+
+
+# webhook events wait here for the reply workers
+events = queue.Queue(maxsize=int(os.environ.get('EVENT_QUEUE_SIZE', 200)))
+webhookStats = {'received': 0, 'duplicates': 0, 'dropped': 0,
+                'handled': 0, 'errors': 0, 'maxDepth': 0}
+# request threads and reply workers update the stats at once
+webhookLock = threading.Lock()
+
+
+def countWebhook(state):
+    with webhookLock:
+        webhookStats[state] += 1
+
+
+def eventId(event):
+    return getattr(event, 'webhook_event_id', None) or getattr(event, 'reply_token', None)
+
+
+class eventLog:
+    # ids of recent events in files/events.db, shared by every gunicorn worker,
+    # LINE redelivers when we answer late or fail
+
+    def __init__(self, path='files/events.db'):
+        self.path = path
+        self.local = threading.local()  # a sqlite connection per thread
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY, at REAL)')
+            self.local.conn = conn
+        return conn
+
+    def claim(self, key):
+        # True for the first delivery, checked and marked in one statement
+        conn = self.connection()
+        claimed = conn.execute('INSERT OR IGNORE INTO seen VALUES (?, ?)', (key, time.time())).rowcount == 1
+
+        # redeliveries stop within a day, forget older ids now and then
+        if claimed and random.random() < 0.01:
+            conn.execute('DELETE FROM seen WHERE at < ?', (time.time() - 86400,))
+        return claimed
+
+    def release(self, key):
+        # not queued after all, a redelivery may have it
+        self.connection().execute('DELETE FROM seen WHERE id = ?', (key,))
+
+
+seenEvents = eventLog()
 
 
 @app.route("/callback", methods=['POST'])
@@ -72,40 +357,292 @@ def callback():
     # get request body as text
     body = request.get_data(as_text=True)
     app.logger.info("Request body: " + body)
-    # handle webhook body
+    # verify the webhook body, replies are sent by the workers
+    lineClients()
     try:
-        handler.handle(body, signature)
+        parsed = webhookParser.parse(body, signature)
     except InvalidSignatureError:
         abort(400)
+
+    for event in parsed:
+        countWebhook('received')
+        key = eventId(event)
+        if key is not None and not seenEvents.claim(key):
+            countWebhook('duplicates')
+            continue
+
+        try:
+            events.put(event, timeout=1)
+        except queue.Full:  # workers can't keep up, let LINE redeliver later
+            if key is not None:
+                seenEvents.release(key)
+            countWebhook('dropped')
+            app.logger.warning("Webhook queue full, dropping events")
+            abort(503)
+
+        with webhookLock:
+            webhookStats['maxDepth'] = max(webhookStats['maxDepth'], events.qsize())
+
     return 'OK'
 
 
-@handler.add(MessageEvent, message=TextMessage)
+def webhookSnapshot(states):
+    with webhookLock:
+        return {state: webhookStats[state] for state in states}
+
+
+# events only ever add up, rate() needs them as counters; the queue goes up and down
+metrics.collect('webhook_events_total', 'counter', 'state',
+                lambda: webhookSnapshot(['received', 'duplicates', 'dropped', 'handled', 'errors']))
+metrics.collect('webhook_queue_depth', 'gauge', 'stat',
+                lambda: dict(webhookSnapshot(['maxDepth']), depth=events.qsize()))
+metrics.collect('cache_hits_total', 'counter', 'cache',
+                lambda: {'flexMessages': flexMessages.hits, 'pages': pages.hits})
+metrics.collect('cache_misses_total', 'counter', 'cache',
+                lambda: {'flexMessages': flexMessages.misses, 'pages': pages.misses})
+
+
+def reply(token, message):
+    try:
+        lineClients()
+        with metrics.timer('stage_seconds', stage='line_reply'):
+            line_bot_api.reply_message(token, message)
+    except LineBotApiError:
+        metrics.inc('errors_total', where='line_reply')
+        raise
+
+
+def dispatch(event):
+    if isinstance(event, MessageEvent):
+        if isinstance(event.message, TextMessage):
+            handle_message(event)
+        elif isinstance(event.message, LocationMessage):
+            handle_location(event)
+
+    # subscribers of the daily push, see push.py
+    elif isinstance(event, FollowEvent):
+        subscribers.record(event.source.user_id, True)
+    elif isinstance(event, UnfollowEvent):
+        subscribers.record(event.source.user_id, False)
+
+
+def replyWorker():
+    while True:
+        event = events.get()
+        try:
+            dispatch(event)
+            countWebhook('handled')
+        except Exception:
+            countWebhook('errors')
+            app.logger.exception("Failed to handle webhook event")
+        finally:
+            events.task_done()
+
+
+for _ in range(int(os.environ.get('REPLY_WORKERS', 4))):
+    threading.Thread(target=replyWorker, daemon=True).start()
+
+
+# ready to send Flex messages, rebuilt only when their file changes
+flexMessages = versionedCache()
+
+
+def countryFlex():
+    with open('permanentfiles/country.json', 'r') as fp:
+        content = json.load(fp)
+    return FlexSendMessage(alt_text='Country', contents=content)
+
+
+def newsFlex():
+    content = news().getNewsJSON()
+    return FlexSendMessage(alt_text='News', contents=content)
+
+
+def getFlexMessage(command):
+    if command == 'country':
+        return flexMessages.get('country', fileVersion('permanentfiles/country.json'), countryFlex)
+    return flexMessages.get('news', snapshotVersion('news'), newsFlex)
+
+
 def handle_message(event):
     input_message = event.message.text.lower()      # input message
 
     # Select Country Rich menus
     if input_message == 'country':
-        with open('permanentfiles/country.json', 'r') as fp:
-            content = json.load(fp)
-        message = FlexSendMessage(alt_text='Country', contents=content)
+        message = getFlexMessage('country')
 
     # News Rich menus
     elif input_message == 'news':
-        content = news().getNewsJSON()
-        message = FlexSendMessage(alt_text='News', contents=content)
+        message = getFlexMessage('news')
 
     else:
         message = TextSendMessage(text='ไม่พบคำสั่ง {}'.format(
             input_message))  # output message
 
-    line_bot_api.reply_message(event.reply_token, message)
+    reply(event.reply_token, message)
 
 
-@handler.add(MessageEvent, message=LocationMessage)
-def handle_message(event):
-    message = TextSendMessage(text='In development')
-    line_bot_api.reply_message(event.reply_token, message)
+# hospitals listed in a location reply
+NEAREST_FACILITIES = int(os.environ.get('NEAREST_FACILITIES', 5))
+
+
+def facilityBubble(facility, km):
+    contents = [
+        {
+            "type": "text",
+            "text": facility.get('province') or '-',
+            "size": "md",
+            "wrap": True
+        },
+        {
+            "type": "text",
+            "text": "{:.1f} กม.".format(km),
+            "size": "md",
+            "weight": "bold"
+        }
+    ]
+    if facility.get('phone'):
+        contents.append({
+            "type": "text",
+            "text": "โทร {}".format(facility['phone']),
+            "size": "md",
+            "wrap": True
+        })
+
+    return {
+        "type": "bubble",
+        "size": "kilo",
+        "header": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": facility['name'],
+                    "size": "lg",
+                    "weight": "bold",
+                    "wrap": True,
+                    "maxLines": 3
+                }
+            ]
+        },
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": contents
+        },
+        "footer": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "button",
+                    "style": "primary",
+                    "color": "#f16913",
+                    "action": {
+                        "type": "uri",
+                        "label": "นำทาง",
+                        "uri": "https://www.google.com/maps/search/?api=1&query={},{}".format(
+                            facility['lat'], facility['lng'])
+                    }
+                }
+            ]
+        },
+        "styles": {
+            "header": {
+                "backgroundColor": "#fae1be"
+            },
+            "body": {
+                "backgroundColor": "#fff1de"
+            }
+        }
+    }
+
+
+def provinceBubble(province, count):
+    return {
+        "type": "bubble",
+        "size": "kilo",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": province,
+                    "size": "lg",
+                    "weight": "bold",
+                    "align": "center",
+                    "wrap": True
+                },
+                {
+                    "type": "text",
+                    "text": "ผู้ติดเชื้อ",
+                    "size": "md",
+                    "align": "center"
+                },
+                {
+                    "type": "text",
+                    "text": str(count),
+                    "size": "3xl",
+                    "weight": "bold",
+                    "align": "center"
+                }
+            ]
+        },
+        "styles": {
+            "body": {
+                "backgroundColor": "#fff1de"
+            }
+        }
+    }
+
+
+def locationFlex(latitude, longitude):
+    nearest = loadFacilities().nearest(latitude, longitude, NEAREST_FACILITIES)
+    if not nearest:
+        return TextSendMessage(text='ไม่พบโรงพยาบาลตรวจโควิดในระยะ {:.0f} กม.'.format(FACILITY_RADIUS))
+
+    bubbles = [facilityBubble(facility, km) for facility, km in nearest]
+
+    # the province of the closest hospital stands in for the user's
+    province = nearest[0][0].get('province')
+    provinces = cases().getProvinceCases()
+    if province in provinces:
+        bubbles.insert(0, provinceBubble(province, provinces[province]))
+
+    return FlexSendMessage(alt_text='Hospitals',
+                           contents={"type": "carousel", "contents": bubbles[:10]})
+
+
+def handle_location(event):
+    message = locationFlex(event.message.latitude, event.message.longitude)
+    reply(event.reply_token, message)
+
+
+def warmUp():
+    # load the snapshots and fill the caches before the worker takes traffic,
+    # pandas, matplotlib and folium are only imported by the code using them
+    start = time.perf_counter()
+
+    iso3Codes.load()
+    loadCountryIndex()
+    # the Flex payloads and the spatial index, built on first use otherwise
+    for command in ['country', 'news']:
+        try:
+            getFlexMessage(command)
+        except FileNotFoundError:
+            app.logger.warning("No Flex payload for {} yet".format(command))
+    loadFacilities()
+    client = app.test_client()
+    for route in ['/', '/world', '/cases']:
+        client.get(route)
+
+    app.logger.info("Warmed up in {:.1f} s".format(time.perf_counter() - start))
+
+
+if os.environ.get('WARMUP', '0') == '1':
+    warmUp()
 
 
 if __name__ == '__main__':
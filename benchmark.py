@@ -0,0 +1,350 @@
+# Offline benchmark of helper.py and the Flask routes, replaying recorded
+# upstream responses from a local stub server.
+#
+#   python benchmark.py --against HEAD    replay bench/fixtures with this tree and with a git revision,
+#                                         both on this host in one session, and compare the two
+#   python benchmark.py                   replay them and compare with bench/baseline.json
+#   python benchmark.py --save-baseline   replay them and store the results as bench/baseline.json
+#   python benchmark.py --record          replace the fixtures with live upstream responses (needs network)
+#   python benchmark.py --imports         time a cold `import app` and list the slowest imports
+#
+# Timings only compare on the host that recorded them, the baseline is local and never committed.
+import os
+import sys
+import json
+import shutil
+import time
+import tarfile
+import argparse
+import resource
+import subprocess
+import tempfile
+import threading
+import statistics
+from io import BytesIO
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(ROOT, 'bench', 'fixtures')
+BASELINE = os.path.join(ROOT, 'bench', 'baseline.json')
+PERMANENT = os.path.join(ROOT, 'bench', 'permanentfiles')
+LOOP = 0.05  # seconds of warm calls per timing
+
+# upstream host and recorded paths, served by the stub under /<name>
+UPSTREAMS = {
+    'workpoint': ('https://covid19.workpointnews.com',
+                  ['/api/world', '/api/cases', '/api/constants', '/live-update']),
+    'csse': ('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master',
+             ['/csse_covid_19_data/csse_covid_19_time_series/time_series_19-covid-Confirmed.csv']),
+}
+
+
+def record():
+    from helper import fetch
+
+    for name, (host, paths) in UPSTREAMS.items():
+        for path in paths:
+            target = os.path.join(FIXTURES, name + path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+
+            with open(target, 'wb') as fp:
+                fp.write(fetch(host + path).content)
+            print('recorded', host + path)
+
+
+class stubHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):  # keep the report readable
+        pass
+
+
+def startStub():
+    handler = partial(stubHandler, directory=FIXTURES)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def prepare(stub, code):
+    # a scratch working directory, the real files/ is never touched
+    work = tempfile.mkdtemp(prefix='bench-')
+    os.makedirs(os.path.join(work, 'files'))
+    os.makedirs(os.path.join(work, 'keys'))
+    for key in ['channel_access_token', 'channel_secret']:
+        with open(os.path.join(work, 'keys', key + '.txt'), 'w') as fp:
+            fp.write('benchmark')
+
+    # the deployed permanent files when present, else the stand-ins shipped with the fixtures
+    permanent = os.path.join(ROOT, 'permanentfiles')
+    if not os.path.isdir(permanent):
+        permanent = PERMANENT
+    os.symlink(permanent, os.path.join(work, 'permanentfiles'))
+
+    os.chdir(work)
+    os.environ.update({'WORKPOINT_URL': stub + '/workpoint',
+                       'CSSE_URL': stub + '/csse',
+                       'SCHEDULER': '0'})
+    sys.path.insert(0, code)
+
+
+def measure(fn, repeat):
+    start = time.perf_counter()
+    fn()
+    first = time.perf_counter() - start
+
+    # warm calls in loops of at least LOOP seconds, a single sub-millisecond
+    # call is mostly timer and scheduler jitter
+    number = max(1, int(LOOP / max(first, 1e-6)))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+
+    return {'first': first, 'median': statistics.median(times), 'min': min(times)}
+
+
+def steps(countryName):
+    # (name, fn) of every step, in the order they have to run
+    import helper
+    import app
+
+    w = helper.world()
+    c = helper.cases()
+    ct = helper.country()
+    n = helper.news()
+    client = app.app.test_client()
+
+    def plotted():
+        # the first country of the time series once it is fetched
+        return countryName or next(iter(helper.loadTimeSeries().countries))
+
+    def get(route):
+        response = client.get(route() if callable(route) else route)
+        if response.status_code != 200:
+            raise Exception('{} answered {}'.format(response.request.path, response.status_code))
+
+    return [
+        # upstream refreshes, against the stub
+        ('refresh.world', w.writeWorldSnapshot),
+        ('refresh.cases', c.writeCases),
+        ('refresh.constants', c.writeConstantsJSON),
+        ('refresh.news', n.writeNewsJSON),
+        ('refresh.timeSeries', ct.writeCountryTimeSeries),
+        # renders without the caches in front of them
+        ('world.getWorldHTML', w.renderWorldHTML),
+        ('world.getWorldMapHTML', w.renderWorldMapHTML),
+        ('cases.getCasesHTML', c.renderCasesHTML),
+        ('country.getCountryPlot', lambda: ct.renderCountryPlot(plotted())),
+        # whole routes, first call is cold and the rest hit the caches
+        ('route /', lambda: get('/')),
+        ('route /world', lambda: get('/world')),
+        ('route /cases', lambda: get('/cases')),
+        ('route /country', lambda: get(lambda: '/country/' + plotted().replace(' ', '-'))),
+    ]
+
+
+def peakRSS():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(repeat, countryName):
+    results = {name: measure(fn, repeat) for name, fn in steps(countryName)}
+
+    return results, peakRSS()
+
+
+def serve(repeat, countryName):
+    # run the steps named on stdin one at a time, for against(); what the
+    # code under test prints goes to stderr, stdout only carries the results
+    reply = sys.stdout
+    sys.stdout = sys.stderr
+
+    table = steps(countryName)
+    reply.write(json.dumps([name for name, _ in table]) + '\n')
+    reply.flush()
+
+    table = dict(table)
+    for line in sys.stdin:
+        name = line.strip()
+        result = peakRSS() if name == 'peakRSS' else measure(table[name], repeat)
+        reply.write(json.dumps(result) + '\n')
+        reply.flush()
+
+
+def importTimes(top):
+    # a fresh interpreter per run, nothing cached from this one
+    work = tempfile.mkdtemp(prefix='bench-')
+    env = dict(os.environ, SCHEDULER='0', PYTHONPATH=ROOT)
+
+    start = time.perf_counter()
+    done = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                          cwd=work, env=env, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.perf_counter() - start
+
+    # "import time: self [us] | cumulative | imported package", nesting shows as
+    # indent, keep app and what it imports directly
+    packages = []
+    for line in done.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[0].startswith('import time:') and parts[1].strip().isdigit():
+            name = parts[2]
+            if len(name) - len(name.lstrip()) <= 3:
+                packages.append((int(parts[1]), name.strip()))
+
+    print('import app: {:.0f} ms wall'.format(wall * 1000))
+    for cumulative, name in sorted(packages, reverse=True)[:top]:
+        print('{:>10.1f} ms  {}'.format(cumulative / 1000, name))
+
+
+def report(results, peak, baseline, tolerance, ratios=None):
+    # ratios, when given, are each step's slowdown measured side by side
+    regressions = []
+
+    # the fastest of the repeats, the one least disturbed by the rest of the host
+    print('{:<34}{:>12}{:>12}{:>12}{:>10}'.format('step', 'first ms', 'min ms', 'base ms', 'change'))
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        change = ''
+        if base:
+            ratio = ratios[name] if ratios else result['min'] / base['min']
+            change = '{:+.0%}'.format(ratio - 1)
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+                change += ' !'
+
+        print('{:<34}{:>12.1f}{:>12.1f}{:>12}{:>10}'.format(
+            name, result['first'] * 1000, result['min'] * 1000,
+            '{:.1f}'.format(base['min'] * 1000) if base else '-', change))
+
+    print('peak RSS {:.0f} MB (baseline {})'.format(
+        peak, '{:.0f} MB'.format(baseline['peakRSS']) if 'peakRSS' in baseline else '-'))
+    if 'peakRSS' in baseline and peak > baseline['peakRSS'] * (1 + tolerance):
+        regressions.append('peak RSS')
+
+    return regressions
+
+
+class benchProcess:
+    # a serve() process benchmarking the helper.py and app.py of code
+
+    def __init__(self, code, args):
+        command = [sys.executable, os.path.abspath(__file__), '--serve', '--code', code,
+                   '--repeat', str(args.repeat)]
+        if args.country:
+            command += ['--country', args.country]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, universal_newlines=True)
+        self.names = self.read()
+
+    def read(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise Exception('benchmark process exited with {}'.format(self.process.wait()))
+        return json.loads(line)
+
+    def ask(self, name):
+        self.process.stdin.write(name + '\n')
+        self.process.stdin.flush()
+        return self.read()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def against(revision, args):
+    # this tree and a git revision side by side on this host right now, each
+    # step run on one then the other, so a slow spell of the host hits both
+    work = tempfile.mkdtemp(prefix='bench-')
+    try:
+        archive = subprocess.run(['git', 'archive', revision], cwd=ROOT, stdout=subprocess.PIPE, check=True)
+        with tarfile.open(fileobj=BytesIO(archive.stdout)) as tar:
+            tar.extractall(work)
+
+        theirs = benchProcess(work, args)
+        ours = benchProcess(os.path.abspath(args.code), args)
+        results = {ours: {}, theirs: {}}
+        paired = {name: [] for name in ours.names}
+        for turn in range(args.rounds):
+            for name in ours.names:
+                pair = {}
+                for side in (ours, theirs) if turn % 2 else (theirs, ours):
+                    result = pair[side] = side.ask(name)
+                    best = results[side].setdefault(name, result)
+                    # cold is the first call of the first round, the rest take the best round
+                    best['min'] = min(best['min'], result['min'])
+                    best['median'] = min(best['median'], result['median'])
+                paired[name].append(pair[ours]['min'] / pair[theirs]['min'])
+
+        peaks = {side: side.ask('peakRSS') for side in (ours, theirs)}
+        for side in (ours, theirs):
+            side.close()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    # the typical round, one odd round either way does not make a regression
+    ratios = {name: statistics.median(values) for name, values in paired.items()}
+    return (results[ours], peaks[ours]), {'results': results[theirs], 'peakRSS': peaks[theirs]}, ratios
+
+
+def main():
+    args = argparse.ArgumentParser(description='Offline benchmark of the COVID-19 bot')
+    args.add_argument('--record', action='store_true', help='record upstream fixtures, needs network')
+    args.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    args.add_argument('--baseline', default=BASELINE, help='baseline file, local to this host')
+    args.add_argument('--against', metavar='REVISION', help='compare with a git revision benchmarked now')
+    args.add_argument('--code', default=ROOT, help='directory of the helper.py and app.py to benchmark')
+    args.add_argument('--repeat', type=int, default=3)
+    args.add_argument('--rounds', type=int, default=5, help='runs of every step on each side with --against')
+    args.add_argument('--country', help='country used for plots, default the first in the time series')
+    args.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown before failing')
+    args.add_argument('--imports', action='store_true', help='measure import time of app.py')
+    args.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = args.parse_args()
+
+    if args.record:
+        record()
+        return
+
+    if args.imports:
+        importTimes(15)
+        return
+
+    if not os.path.isdir(FIXTURES):
+        sys.exit('no fixtures in {}, run with --record first'.format(FIXTURES))
+
+    if args.serve:
+        prepare(startStub(), os.path.abspath(args.code))
+        serve(args.repeat, args.country)
+        return
+
+    ratios = None
+    if args.against:
+        (results, peak), baseline, ratios = against(args.against, args)
+    else:
+        prepare(startStub(), os.path.abspath(args.code))
+        results, peak = run(args.repeat, args.country)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fp:
+            json.dump({'results': results, 'peakRSS': peak}, fp, indent=4)
+
+    if not args.against:
+        try:
+            with open(args.baseline, 'r') as fp:
+                baseline = json.load(fp)
+        except FileNotFoundError:
+            baseline = {}
+
+    regressions = report(results, peak, baseline, args.tolerance, ratios)
+    if regressions and not args.save_baseline:
+        sys.exit('slower than {}: {}'.format(args.against or 'baseline', ', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
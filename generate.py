@@ -0,0 +1,126 @@
+# Render /world, /cases and every /country/<name> page of one data snapshot
+# into a static directory, ready to upload to a CDN or object store.
+#
+#   python generate.py --out site            render what changed since the last run
+#   python generate.py --out site --refresh  fetch fresh snapshots first
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# the generator reads the snapshots in files/, it never refreshes on its own
+os.environ['SCHEDULER'] = '0'
+
+import app as site
+from helper import (country, cases, refresher, scheduler, plots, loadCountryIndex,
+                    snapshotVersion, seriesVersion, fileVersion, atomicOpen,
+                    CASES_PAGE_SIZE)
+
+
+def renderPlotJob(name):
+    # runs in a pool process, name is the time series row
+    return name, country().renderCountryPlot(name)
+
+
+def writePage(out, path, body, manifest, version):
+    target = os.path.join(out, path, 'index.html')
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    # leave identical pages alone so uploads only carry what changed
+    digest = hashlib.sha1(body).hexdigest()
+    if manifest.get(path, {}).get('sha1') != digest or not os.path.exists(target):
+        with atomicOpen(target, 'wb') as fp:
+            fp.write(body)
+
+    manifest[path] = {'version': version, 'sha1': digest}
+
+
+def isFresh(out, path, manifest, version):
+    return (manifest.get(path, {}).get('version') == version
+            and os.path.exists(os.path.join(out, path, 'index.html')))
+
+
+def main():
+    args = argparse.ArgumentParser(description='Render the web pages into a static directory')
+    args.add_argument('--out', default='site', help='output directory')
+    args.add_argument('--workers', type=int, default=os.cpu_count(), help='plot rendering processes')
+    args.add_argument('--refresh', action='store_true', help='fetch every snapshot before rendering')
+    args = args.parse_args()
+
+    if args.refresh:
+        for mode in scheduler.intervals:
+            refresher.refreshOnce(mode, True)
+
+    try:
+        with open(os.path.join(args.out, '.manifest.json'), 'r') as fp:
+            manifest = json.load(fp)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        manifest = {}
+
+    # static pages can't call the series api, embed the PNG instead,
+    # and link the case pages by path
+    site.CLIENT_CHARTS = False
+    site.STATIC_SITE = True
+    client = site.app.test_client()
+
+    def get(route):
+        response = client.get(route)
+        if response.status_code != 200:
+            raise Exception('{} answered {}'.format(route, response.status_code))
+        return response.get_data()
+
+    worldVersion = str(snapshotVersion('world'))
+    casesVersion = '{}-{}'.format(snapshotVersion('cases'), snapshotVersion('constants'))
+    for path, route, version in [('', '/', worldVersion), ('world', '/world', worldVersion)]:
+        if not isFresh(args.out, path, manifest, version):
+            writePage(args.out, path, get(route), manifest, version)
+            print('rendered', route)
+
+    # every page of the cases table, cases/ then cases/2/, cases/3/...
+    _, total = cases().getCasesPage(1, CASES_PAGE_SIZE)
+    casePages = max((total + CASES_PAGE_SIZE - 1) // CASES_PAGE_SIZE, 1)
+    for page in range(1, casePages + 1):
+        path = 'cases' if page == 1 else 'cases/{}'.format(page)
+        if not isFresh(args.out, path, manifest, casesVersion):
+            writePage(args.out, path, get('/cases?page={}'.format(page)), manifest, casesVersion)
+    print('rendered {} cases pages'.format(casePages))
+
+    # pages past the end of a shorter table
+    for path in [path for path in manifest if path.startswith('cases/')]:
+        if int(path.split('/')[1]) > casePages:
+            shutil.rmtree(os.path.join(args.out, path), ignore_errors=True)
+            del manifest[path]
+
+    # every country of the menu and the time series that has numbers to show
+    index = loadCountryIndex()
+    keys = [key for key in set(index.emoji) | set(index.series)
+            if key in index.world and key in index.series]
+    countryVersion = '{}-{}-{}'.format(snapshotVersion('world'), seriesVersion(),
+                                       fileVersion('permanentfiles/country.json'))
+    todo = {index.series[key]: index.world[key] for key in keys
+            if not isFresh(args.out, 'country/' + index.world[key].replace(' ', '-'), manifest, countryVersion)}
+
+    # plots are the slow part, spread them over processes; never fork this
+    # one, import app already started threads that may hold locks
+    with ProcessPoolExecutor(max_workers=args.workers,
+                             mp_context=multiprocessing.get_context('forkserver')) as pool:
+        for seriesName, encoded in pool.map(renderPlotJob, todo, chunksize=4):
+            plots.put((seriesName, seriesVersion()), encoded)
+
+            worldName = todo[seriesName]
+            path = 'country/' + worldName.replace(' ', '-')
+            writePage(args.out, path, get('/' + path), manifest, countryVersion)
+
+    print('rendered {} countries, {} unchanged'.format(len(todo), len(keys) - len(todo)))
+
+    os.makedirs(args.out, exist_ok=True)
+    with atomicOpen(os.path.join(args.out, '.manifest.json'), 'w') as fp:
+        json.dump(manifest, fp, indent=4)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
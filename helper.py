@@ -1,60 +1,806 @@
+import os
 import re
 import csv
 import json
-import folium
+import math
+import bisect
+import time
+import fcntl
+import glob
 import base64
-import pandas as pd
-from io import BytesIO
+import codecs
+import shutil
+import signal
+import tempfile
+import threading
+from io import BytesIO, StringIO
+from contextlib import contextmanager
+from difflib import get_close_matches
 from string import capwords
 from datetime import datetime
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import country_converter as coco
-from bs4 import BeautifulSoup as soup
-from urllib.request import Request, urlopen
+from collections import OrderedDict
+import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import multiprocessing
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from instrument import metrics
+
+
+# upstream hosts, overridable to replay recorded responses offline
+WORKPOINT_URL = os.environ.get('WORKPOINT_URL', 'https://covid19.workpointnews.com')
+CSSE_URL = os.environ.get('CSSE_URL', 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master')
+
+# (connect, read) timeouts in seconds of each upstream host
+TIMEOUTS = {'covid19.workpointnews.com': (3, 15),
+            'raw.githubusercontent.com': (3, 30)}
+
+
+def makeSession():
+    # keep-alive connections to every upstream, reused by all refreshes
+    retry = Retry(total=3, backoff_factor=0.5,
+                  status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'User-Agent': 'Mozilla/5.0',
+                            'Accept-Encoding': 'gzip, deflate'})
+    return session
+
+
+http = makeSession()
+
+
+def fetch(url, headers=None, stream=False):
+    host = urlparse(url).hostname
+    timeout = TIMEOUTS.get(host, (3, 15))
+
+    try:
+        with metrics.timer('upstream_fetch_seconds', host=host):
+            response = http.get(url, headers=headers, timeout=timeout, stream=stream)
+
+            if response.status_code != 304:
+                response.raise_for_status()
+    except Exception:
+        metrics.inc('errors_total', where='fetch')
+        raise
+
+    return response
 
 
 def parser(url):
 
-    headers = {'User-Agent': 'Mozilla/5.0',
-               'Referer': 'https://covid19.workpointnews.com/?to=THAILAND'}
-    req = Request(url, headers=headers)
+    headers = {'Referer': 'https://covid19.workpointnews.com/?to=THAILAND'}
 
-    # open up connection, grap the page
-    uClient = urlopen(req)
-    page_html = uClient.read()
-    uClient.close()  # close connection
+    # grap the page over a pooled connection
+    page_html = fetch(url, headers).content
 
     # load data to json format for easy accessing
     page_json = json.loads(page_html)
     return page_json
 
 
-def writeCSV(mode):
-    if mode == 'cases':
-        c = cases()
-        df = c.getCasesData()
-    elif mode == 'world':
-        w = world()
-        df = w.getWorldData()
-    else:
-        print("Wrong Mode")
-        raise Exception
-
-    # write to csv file
-    csv = df.to_csv(index=False)
-    with open('files/' + mode + '.csv', 'w') as fp:
-        fp.write(csv)
-
-    # write a timestamp of the file created
-    with open('files/' + mode + 'LastUpdate.txt', 'w') as fp:
+# umask can only be read by setting it, do it once before any thread starts
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+@contextmanager
+def atomicOpen(path, mode='w', **kwargs):
+    # write next to the target then rename over it,
+    # readers see either the old or the new file, never a partial one
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    # mkstemp makes it 0600, give it the mode a plain open would have
+    os.fchmod(fd, 0o666 & ~UMASK)
+    try:
+        with open(fd, mode, **kwargs) as fp:
+            yield fp
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+flightLocks = {}
+flightLock = threading.Lock()
+
+
+@contextmanager
+def singleFlight(name):
+    # at most one holder per name across threads and gunicorn processes,
+    # the others get False and carry on with the old snapshot
+    with flightLock:
+        threadLock = flightLocks.setdefault(name, threading.Lock())
+
+    if not threadLock.acquire(blocking=False):
+        yield False
+        return
+
+    try:
+        with open('files/' + name + '.lock', 'w') as fp:
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                acquired = True
+            except OSError:  # another process is refreshing
+                acquired = False
+
+            yield acquired  # closing the file releases the flock
+    finally:
+        threadLock.release()
+
+
+def writeTimestamp(mode):
+    with atomicOpen('files/' + mode + 'LastUpdate.txt', 'w') as fp:
         fp.write(str(datetime.utcnow()))
 
 
+def isStale(mode, minutes):
+    try:
+        with open('files/' + mode + 'LastUpdate.txt', 'r') as fp:
+            timestamp = fp.read()
+    except FileNotFoundError:  # never fetched
+        return True
+
+    lastUpdate = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
+    differ = datetime.utcnow() - lastUpdate
+
+    # total_seconds, .seconds alone wraps around every day
+    return differ.total_seconds() > minutes * 60
+
+
+# columns of each snapshot
+COLUMNS = {'world': ['Country', 'Confirmed', 'Recovered', 'Death', 'Travel'],
+           'cases': ['Number', 'Job', 'Origin', 'Type']}
+
+
+class scheduler:
+    # refresh interval in minutes of each snapshot
+    intervals = {'world': 15, 'cases': 15, 'constants': 15,
+                 'news': 30, 'timeSeries': 60}
+    tick = 30  # seconds between staleness checks
+    retry = 120  # seconds to wait after a failed refresh
+
+    def __init__(self):
+        self.thread = None
+        self.lockFile = None
+        self.pending = set()
+        self.failed = {}
+        self.wake = threading.Event()
+
+    def refresh(self, mode):
+        if mode == 'world':
+            world().writeWorldSnapshot()
+        elif mode == 'cases':
+            cases().writeCases()
+        elif mode == 'constants':
+            cases().writeConstantsJSON()
+        elif mode == 'news':
+            news().writeNewsJSON()
+        elif mode == 'timeSeries':
+            country().writeCountryTimeSeries()
+
+    def isLeader(self):
+        # only one process of the gunicorn group holds the lock and refreshes,
+        # the others keep serving whatever snapshot is on disk
+        if self.lockFile is not None:
+            return True
+
+        fp = open('files/scheduler.lock', 'w')
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:  # another process is the leader
+            fp.close()
+            return False
+
+        self.lockFile = fp
+        return True
+
+    def runOnce(self, leader=True):
+        pending = self.pending
+        self.pending = set()
+
+        due = []
+        for mode, minutes in self.intervals.items():
+            # other processes only serve the snapshots they were asked for
+            if mode not in pending and (not leader or not isStale(mode, minutes)):
+                continue
+            if time.time() - self.failed.get(mode, 0) < self.retry:
+                continue
+            due.append(mode)
+
+        if not due:
+            return
+
+        # fetch every due snapshot at once, they hit different endpoints
+        with ThreadPoolExecutor(max_workers=len(due)) as pool:
+            for mode in due:
+                pool.submit(self.refreshOnce, mode, mode in pending)
+
+    def refreshOnce(self, mode, forced):
+        with singleFlight(mode) as acquired:
+            if not acquired:  # somebody else is already on it
+                return
+            # it may have been refreshed while we waited for the lock
+            if not forced and not isStale(mode, self.intervals[mode]):
+                return
+
+            try:
+                with metrics.timer('refresh_seconds', snapshot=mode):
+                    self.refresh(mode)
+                self.failed.pop(mode, None)
+            except Exception as e:  # keep serving the last good snapshot
+                self.failed[mode] = time.time()
+                metrics.inc('errors_total', where='refresh_' + mode)
+                print('refresh {} failed: {}'.format(mode, e))
+
+    def run(self):
+        os.makedirs('files', exist_ok=True)
+
+        while True:
+            self.runOnce(self.isLeader())
+
+            self.wake.wait(self.tick)
+            self.wake.clear()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def kick(self, mode):
+        # ask for a refresh soon, without waiting for it
+        self.pending.add(mode)
+        self.wake.set()
+
+
+refresher = scheduler()
+
+
+def fileVersion(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def snapshotVersion(mode):
+    # the timestamp file is written after its snapshot, so its mtime
+    # changes exactly when a new snapshot is in place
+    return fileVersion('files/' + mode + 'LastUpdate.txt')
+
+
+def seriesVersion():
+    # a 304 only touches the timestamp, the index is rewritten (after the
+    # matrix) when new data comes in, so caches keyed on it survive refreshes
+    return fileVersion('files/timeseriesIndex.json')
+
+
+class versionedCache:
+    # keep one rendered value per key, rebuilt when its snapshot version changes
+
+    def __init__(self):
+        self.entries = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, build):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+
+        with self.lock:
+            keyLock = self.locks.setdefault(key, threading.Lock())
+
+        # only one thread builds a key, the others wait for its result
+        with keyLock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            value = build()
+            self.entries[key] = (version, value)
+
+        return value
+
+
+fragments = versionedCache()
+stores = versionedCache()
+
+# decimals kept in map coordinates, unset keeps the full geometry
+MAP_PRECISION = os.environ.get('MAP_PRECISION')
+
+
+def quantize(coords, precision):
+    if isinstance(coords[0], (int, float)):  # a single position
+        return [round(c, precision) for c in coords]
+
+    if isinstance(coords[0][0], (int, float)):  # a ring, drop repeated points
+        ring = []
+        for point in coords:
+            point = [round(c, precision) for c in point]
+            if not ring or point != ring[-1]:
+                ring.append(point)
+
+        if len(ring) >= 4:
+            return ring
+        # too small to simplify, keep every point
+        return [[round(c, precision) for c in point] for point in coords]
+
+    return [quantize(c, precision) for c in coords]
+
+
+geoJSON = None
+
+
+def loadGeoJSON():
+    # parse the world borders once per process
+    global geoJSON
+
+    if geoJSON is None:
+        with open('permanentfiles/worldCountry.json', 'r') as j:
+            geo = json.load(j)
+
+        for feature in geo['features']:
+            # the map only needs the id, keep the page small
+            feature['properties'] = {'name': feature.get('properties', {}).get('name')}
+            if MAP_PRECISION:
+                geometry = feature['geometry']
+                geometry['coordinates'] = quantize(
+                    geometry['coordinates'], int(MAP_PRECISION))
+
+        geoJSON = geo
+
+    return geoJSON
+
+
+class countryCodes:
+    # name -> ISO3, seeded from country_converter's table and kept in files/iso3.json
+
+    def __init__(self):
+        self.index = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        import country_converter as coco
+        cc = coco.CountryConverter()
+
+        index = {}
+        for col in ['ISO2', 'name_official', 'name_short', 'ISO3']:
+            for name, code in zip(cc.data[col], cc.data['ISO3']):
+                index[str(name)] = code
+
+        # names resolved by regex on a previous run
+        try:
+            with open('files/iso3.json', 'r') as fp:
+                index.update(json.load(fp))
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            pass
+
+        self.index = index
+
+    def convert(self, names):
+        import country_converter as coco
+        with self.lock:
+            if self.index is None:
+                self.load()
+
+            # only names never seen before go through coco's regex matching
+            missing = list({name for name in names if name not in self.index})
+            if missing:
+                codes = coco.convert(missing, to='ISO3')
+                if len(missing) == 1:
+                    codes = [codes]
+
+                learned = dict(zip(missing, codes))
+                self.index.update(learned)
+
+                try:
+                    with open('files/iso3.json', 'r') as fp:
+                        learned.update(json.load(fp))
+                except (FileNotFoundError, json.decoder.JSONDecodeError):
+                    pass
+                with atomicOpen('files/iso3.json', 'w') as fp:
+                    json.dump(learned, fp)
+
+        return [self.index[name] for name in names]
+
+
+iso3Codes = countryCodes()
+
+
+class lruCache:
+    # least recently used values, bounded by their total size in bytes
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.maxBytes:  # would evict everything else
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self.entries[key] = value
+            self.size += len(value)
+
+            while self.size > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+# rendered country plots, PLOT_CACHE_BYTES caps the memory of each worker
+plots = lruCache(int(os.environ.get('PLOT_CACHE_BYTES', 32 * 1024 * 1024)))
+
+
+def renderPlot(date, case):
+    import matplotlib.dates as mdates
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    # a standalone Figure, no pyplot state to share between threads or leak
+    fig = Figure(figsize=(9, 8))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.plot(date, case, linewidth=5)
+    ax.tick_params(labelsize=18)
+
+    # format the Date axis
+    locator = mdates.AutoDateLocator()
+    formatter = mdates.ConciseDateFormatter(locator)
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(formatter)
+
+    # save to html, drawing happens here
+    tmp = BytesIO()
+    with metrics.timer('stage_seconds', stage='plot'):
+        fig.savefig(tmp, format='png')
+    encoded = base64.b64encode(tmp.getvalue()).decode('ascii')
+
+    return encoded
+
+
+# matplotlib's Oranges, the ColorBrewer colours it interpolates between
+ORANGES = ['#fff5eb', '#fee6ce', '#fdd0a2', '#fdae6b', '#fd8d3c',
+           '#f16913', '#d94801', '#a63603', '#7f2704']
+
+
+def gradientScale(colours, n=256):
+    # (background, text) of n steps, the text turns light on dark
+    # backgrounds the way pandas' background_gradient does
+    rgb = [[int(c[i:i + 2], 16) / 255 for i in (1, 3, 5)] for c in colours]
+
+    scale = []
+    for step in range(n):
+        x = step / (n - 1) * (len(rgb) - 1)
+        low = min(int(x), len(rgb) - 2)
+        t = x - low
+        colour = [a + (b - a) * t for a, b in zip(rgb[low], rgb[low + 1])]
+
+        linear = [c / 12.92 if c <= 0.03928 else ((c + 0.055) / 1.055) ** 2.4 for c in colour]
+        luminance = 0.2126 * linear[0] + 0.7152 * linear[1] + 0.0722 * linear[2]
+
+        scale.append(('#' + ''.join('{:02x}'.format(round(c * 255)) for c in colour),
+                      '#f1f1f1' if luminance < 0.408 else '#000000'))
+
+    return scale
+
+
+oranges = gradientScale(ORANGES)
+
+
+def topMean(values, count):
+    # mean of the largest values, the vmax of the gradients
+    import numpy as np
+    return np.sort(np.asarray(values))[::-1][:count].sum() / count
+
+
+def gradientSteps(values, vmax, steps):
+    # step of the scale of every value, from the column minimum up to vmax
+    import numpy as np
+    values = np.asarray(values, dtype=np.float64)
+    vmin = values.min()
+    if vmax <= vmin:
+        return np.zeros(len(values), dtype=np.intp)
+
+    return np.clip((values - vmin) / (vmax - vmin) * steps, 0, steps - 1).astype(np.intp)
+
+
+def renderTable(name, header, columns, style, fontSize, gradients=None):
+    # one CSS rule per colour in use instead of one per cell,
+    # gradients maps a column to the vmax of its Oranges scale
+    from html import escape
+    gradients = gradients or {}
+    rules = ['.{0} td{{{1};font-size:{2}}}.{0} th{{font-size:{2}}}'.format(
+        name, ';'.join('{}:{}'.format(k, v) for k, v in style.items()), fontSize)]
+
+    used = set()
+    cells = []
+    for title, values in zip(header, columns):
+        text = [escape(str(v)) for v in values]
+
+        if title in gradients and len(text):
+            steps = gradientSteps(values, gradients[title], len(oranges))
+            used.update(steps.tolist())
+            cells.append(['<td class="g{}">{}</td>'.format(step, t) for step, t in zip(steps.tolist(), text)])
+        else:
+            cells.append(['<td>{}</td>'.format(t) for t in text])
+
+    for step in sorted(used):
+        rules.append('.{} td.g{}{{background-color:{};color:{}}}'.format(name, step, *oranges[step]))
+
+    head = ''.join('<th>{}</th>'.format(escape(title)) for title in header)
+    body = ''.join('<tr>' + ''.join(row) + '</tr>' for row in zip(*cells))
+
+    return ('<style type="text/css">{}</style><table class="{}"><thead><tr>{}</tr></thead>'
+            '<tbody>{}</tbody></table>').format(''.join(rules), name, head, body)
+
+
+class worldSnapshot:
+    # files/world links to a directory holding one .npy per column,
+    # memory-mapped so every worker shares the same pages
+
+    def __init__(self, empty=False):
+        import numpy as np
+        if empty:
+            self.columns = {col: np.array([], dtype=np.int64) for col in COLUMNS['world']}
+            self.columns['Country'] = self.columns['Travel'] = np.array([], dtype=str)
+        else:
+            # resolve the link once, a refresh may swing it meanwhile
+            path = os.path.realpath('files/world')
+            self.columns = {col: np.load(os.path.join(path, col + '.npy'), mmap_mode='r')
+                            for col in COLUMNS['world']}
+
+        self.rows = {str(name): row for row, name in enumerate(self.columns['Country'])}
+        # rank by Confirmed cases
+        self.order = np.argsort(-self.columns['Confirmed'], kind='stable')
+        self.total = {col: int(self.columns[col].sum()) for col in ['Confirmed', 'Recovered', 'Death']}
+
+    def get(self, country):
+        row = self.rows[country]  # KeyError when unknown
+        return [int(self.columns[col][row]) for col in ['Confirmed', 'Recovered', 'Death']]
+
+
+def loadWorld():
+    if not os.path.isdir('files/world'):  # no snapshot yet, never wait for upstream
+        refresher.kick('world')
+        return worldSnapshot(empty=True)
+
+    with metrics.timer('stage_seconds', stage='snapshot_load'):
+        return stores.get('world', snapshotVersion('world'), worldSnapshot)
+
+
+# every world snapshot, compressed columnar chunks under files/history
+HISTORY = 'files/history'
+HISTORY_CHUNK = 96  # snapshots per chunk, a day of 15 minute refreshes
+HISTORY_COLUMNS = ['Confirmed', 'Recovered', 'Death']
+
+
+class worldHistory:
+    # one row per (country, snapshot) in .npz chunks of HISTORY_CHUNK snapshots,
+    # only the last chunk is ever rewritten. index.json holds the country names
+    # the rows refer to and the time range of each chunk, so a lookup opens
+    # just the chunk covering the time asked for
+
+    def __init__(self, path=HISTORY):
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = OrderedDict()  # file -> (version, arrays) of the last chunks read
+
+    def readIndex(self):
+        try:
+            with open(os.path.join(self.path, 'index.json'), 'r', encoding='utf-8') as fp:
+                return json.load(fp)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):  # nothing recorded yet
+            return {'countries': [], 'chunks': []}
+
+    def readChunk(self, name):
+        import numpy as np
+        path = os.path.join(self.path, name)
+        version = fileVersion(path)
+
+        with self.lock:
+            entry = self.loaded.get(name)
+            if entry is not None and entry[0] == version:
+                self.loaded.move_to_end(name)
+                return entry[1]
+
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in data.files}
+
+        with self.lock:
+            self.loaded[name] = (version, arrays)
+            while len(self.loaded) > 4:
+                self.loaded.popitem(last=False)
+
+        return arrays
+
+    def rowsAt(self, index, when):
+        # rows of the last snapshot taken at or before when, None before the first
+        import numpy as np
+        chunks = index['chunks']
+        i = bisect.bisect_right([chunk['start'] for chunk in chunks], when) - 1
+        if i < 0:
+            return None
+
+        data = self.readChunk(chunks[i]['file'])
+        stop = np.searchsorted(data['time'], when, side='right')
+        start = np.searchsorted(data['time'], data['time'][stop - 1], side='left')
+
+        return {key: values[start:stop] for key, values in data.items()}
+
+    def append(self, countries, values, when):
+        # values holds the HISTORY_COLUMNS of countries, when is in epoch seconds
+        import numpy as np
+        os.makedirs(self.path, exist_ok=True)
+        index = self.readIndex()
+
+        codes = {name: code for code, name in enumerate(index['countries'])}
+        for name in countries:
+            if name not in codes:
+                codes[name] = len(index['countries'])
+                index['countries'].append(name)
+
+        rows = {'time': np.full(len(countries), when, dtype=np.int64),
+                'country': np.array([codes[name] for name in countries], dtype=np.int32)}
+        rows.update({col: np.asarray(values[col], dtype=np.int64) for col in HISTORY_COLUMNS})
+
+        chunks = index['chunks']
+        # time of the latest refresh, the windows of changes end here
+        index['latest'] = when
+
+        if chunks:
+            # upstream often hasn't moved since the last refresh, keep no rows then
+            last = self.rowsAt(index, chunks[-1]['end'])
+            before, after = np.argsort(last['country']), np.argsort(rows['country'])
+            if all(np.array_equal(last[key][before], rows[key][after])
+                   for key in ['country'] + HISTORY_COLUMNS):
+                with atomicOpen(os.path.join(self.path, 'index.json'), 'w', encoding='utf-8') as fp:
+                    json.dump(index, fp, ensure_ascii=False)
+                return
+
+        if chunks and chunks[-1]['snapshots'] < HISTORY_CHUNK:
+            chunk = chunks[-1]
+            old = self.readChunk(chunk['file'])
+            rows = {key: np.concatenate([old[key], rows[key]]) for key in rows}
+        else:
+            chunk = {'file': 'chunk-{}.npz'.format(when), 'start': when, 'snapshots': 0}
+            chunks.append(chunk)
+
+        chunk['end'] = when
+        chunk['snapshots'] += 1
+
+        # the chunk first, an index never points past what is on disk
+        with atomicOpen(os.path.join(self.path, chunk['file']), 'wb') as fp:
+            np.savez_compressed(fp, **rows)
+        with atomicOpen(os.path.join(self.path, 'index.json'), 'w', encoding='utf-8') as fp:
+            json.dump(index, fp, ensure_ascii=False)
+
+    def changes(self, hours=24):
+        # changes over the last hours up to the latest refresh,
+        # None until the history reaches that far back
+        index = self.readIndex()
+        if not index['chunks']:
+            return None
+
+        end = index.get('latest', index['chunks'][-1]['end'])
+        now = self.rowsAt(index, end)
+        then = self.rowsAt(index, end - hours * 3600)
+        if then is None:
+            return None
+
+        return worldChanges(index['countries'], now, then)
+
+
+class worldChanges:
+    # per country difference between two snapshots of the history
+
+    def __init__(self, countries, now, then):
+        import numpy as np
+        # countries present in both, aligned by their code
+        common, nowAt, thenAt = np.intersect1d(now['country'], then['country'], return_indices=True)
+
+        self.names = [countries[code] for code in common]
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self.since = int(then['time'][0])
+        self.delta = {col: now[col][nowAt] - then[col][thenAt] for col in HISTORY_COLUMNS}
+
+        before = then['Confirmed'][thenAt].astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.growth = np.where(before > 0, self.delta['Confirmed'] / before, np.nan)
+
+    def get(self, country):
+        # {'Confirmed': new cases, ..., 'Growth': fraction or None}, None when unknown
+        row = self.rows.get(country)
+        if row is None:
+            return None
+
+        change = {col: int(self.delta[col][row]) for col in HISTORY_COLUMNS}
+        growth = self.growth[row]
+        change['Growth'] = None if growth != growth else float(growth)  # nan
+        return change
+
+    def total(self):
+        return {col: int(self.delta[col].sum()) for col in HISTORY_COLUMNS}
+
+    def top(self, count=10):
+        # countries with the most new confirmed cases
+        import numpy as np
+        order = np.argsort(-self.delta['Confirmed'], kind='stable')[:count]
+        return [(self.names[row], self.get(self.names[row])) for row in order]
+
+
+history = worldHistory()
+
+
+def loadChanges():
+    return stores.get('worldChanges', snapshotVersion('world'), history.changes)
+
+
 class world:
 
+    def writeWorldSnapshot(self):
+        import numpy as np
+        import pandas as pd
+        df = self.getWorldData()
+
+        # a fresh directory per snapshot, then swing the files/world link to it
+        target = 'files/world.{}'.format(time.time_ns())
+        os.makedirs(target)
+        np.save(os.path.join(target, 'Country.npy'), df['Country'].to_numpy(dtype=str))
+        for col in ['Confirmed', 'Recovered', 'Death']:
+            np.save(os.path.join(target, col + '.npy'), df[col].to_numpy(dtype=np.int64))
+        np.save(os.path.join(target, 'Travel.npy'),
+                np.array(['' if pd.isna(v) else str(v) for v in df['Travel']], dtype=str))
+
+        link = 'files/.world.link'
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink(os.path.basename(target), link)
+        os.replace(link, 'files/world')
+
+        # the snapshot is already live, a broken history must not hold it back
+        try:
+            history.append([str(name) for name in df['Country']], df, int(time.time()))
+        except Exception as e:
+            metrics.inc('errors_total', where='history')
+            print('world history append failed: {}'.format(e))
+
+        # keep the previous snapshot, a worker may still be loading it
+        for old in sorted(glob.glob('files/world.*'))[:-2]:
+            shutil.rmtree(old, ignore_errors=True)
+
+        writeTimestamp('world')
+
     def getWorldData(self):
-        url = "https://covid19.workpointnews.com/api/world"
+        import pandas as pd
+        url = WORKPOINT_URL + "/api/world"
 
         json = parser(url)
 
@@ -84,75 +830,52 @@ class world:
         return df
 
     def getWorldHTML(self):
-        try:
-            # write a timestamp of last get data
-            with open('files/worldLastUpdate.txt', 'r') as fp:
-                timestamp = fp.read()
-
-            now = datetime.utcnow()
-            lastUpdate = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
-            differ = now - lastUpdate
-
-            # write new dataframe when more than 15 mins
-            if differ.seconds > 15 * 60:
-                writeCSV('world')  # timestamp get updated in here
-
-            # read csv to get data
-            df = pd.read_csv('files/world.csv', index_col=False)
-
-        except FileNotFoundError:  # write new if not found
-            writeCSV('world')  # timestamp get updated in here
-            df = pd.read_csv('files/world.csv', index_col=False)
-
-        df = df.fillna('')  # fill na with blank instead
-        # Sort by Confirmed Cases
-        df.sort_values(by='Confirmed', ascending=False,
-                       inplace=True, ignore_index=True)
-
-        # make index start at 1
-        df.index += 1
-        df.index.name = 'Rank'
-        # make Rank as one of the columns
-        df.reset_index(level=0, inplace=True)
-
-        # for gradient
-        sortedRecovered = df['Recovered'].to_list()
-        sortedRecovered.sort(reverse=True)
-        sortedDeath = df['Death'].to_list()
-        sortedDeath.sort(reverse=True)
-
-        # set style
-        fontSize = '27pt'
-        df = df.style.set_properties(**{'text-align': 'center',
-                                        'border-color': 'black',
-                                        'font-size': fontSize,
-                                        'background-color': '#f7f1df',
-                                        'color': 'black'})\
-            .set_table_styles([{'selector': 'th', 'props': [('font-size', fontSize)]}])\
-            .background_gradient(cmap='Oranges', subset='Confirmed', vmax=sum(df['Confirmed'][0:10].to_list())/10)\
-            .background_gradient(cmap='Oranges', subset='Recovered', vmax=sum(sortedRecovered[0:11])/11)\
-            .background_gradient(cmap='Oranges', subset='Death', vmax=sum(sortedDeath[0:5])/5)
-
-        return df.hide_index().render()
+        return fragments.get('worldHTML', snapshotVersion('world'), self.renderWorldHTML)
+
+    def renderWorldHTML(self):
+        # read the last snapshot, the scheduler keeps it fresh
+        snapshot = loadWorld()
+
+        import numpy as np
+        order = snapshot.order
+        columns = [np.arange(1, len(order) + 1)] + [np.asarray(snapshot.columns[col])[order]
+                                                   for col in COLUMNS['world']]
+
+        # gradients stop at the mean of the leading countries
+        gradients = {}
+        if len(order):
+            gradients = {'Confirmed': topMean(snapshot.columns['Confirmed'], 10),
+                         'Recovered': topMean(snapshot.columns['Recovered'], 11),
+                         'Death': topMean(snapshot.columns['Death'], 5)}
+
+        with metrics.timer('stage_seconds', stage='table'):
+            return renderTable('world', ['Rank'] + COLUMNS['world'], columns,
+                               {'text-align': 'center', 'border-color': 'black',
+                                'background-color': '#f7f1df', 'color': 'black'},
+                               '27pt', gradients)
 
     def getWorldMapHTML(self):
-        try:
-            df = pd.read_csv('files/world.csv', index_col=False)
-        except FileNotFoundError:  # write new if not found
-            writeCSV('world')  # timestamp get updated in here
-            df = pd.read_csv('files/world.csv', index_col=False)
+        return fragments.get('worldMapHTML', snapshotVersion('world'), self.renderWorldMapHTML)
+
+    def renderWorldMapHTML(self):
+        import folium
+        import numpy as np
+        import pandas as pd
+        snapshot = loadWorld()
+        if not snapshot.rows:  # nothing fetched yet
+            return ''
 
-        # drop all dates except lastest
-        df.drop(df.columns[2:], axis=1, inplace=True)
-        df['Country'] = coco.convert(df['Country'].to_list(), to='ISO3')
+        # only names and confirmed cases
+        df = pd.DataFrame({'Country': [str(name) for name in snapshot.columns['Country']],
+                           'Confirmed': np.asarray(snapshot.columns['Confirmed'])})
+        df['Country'] = iso3Codes.convert(df['Country'].to_list())
 
         bins = list(df['Confirmed'].quantile([0, 0.7, 0.8, 0.99, 1]))
 
-        try:
-            with open('permanentfiles/worldCountry.json', 'r') as j:
-                geo = json.loads(j.read())
-        except FileNotFoundError:
-            raise Exception
+        # folium writes styles into the features, give it its own copies
+        geo = loadGeoJSON()
+        geo = {'type': geo['type'],
+               'features': [dict(f, properties=dict(f['properties'])) for f in geo['features']]}
 
         # follium
         m = folium.Map(location=[0, 0], zoom_start=2, width=960, height=500)
@@ -173,254 +896,869 @@ class world:
             reset=True
         ).add_to(m)
 
-        return m._repr_html_().replace('padding-bottom:60%;', 'padding-bottom:40%;')
+        with metrics.timer('stage_seconds', stage='map'):
+            return m._repr_html_().replace('padding-bottom:60%;', 'padding-bottom:40%;')
 
     def getWorldTotal(self):
-        total = pd.read_csv('files/world.csv', index_col=False)
-        total.drop(['Country', 'Travel'], axis=1, inplace=True)
-        total = total.sum().to_dict()
+        return loadWorld().total
+
+    def getWorldChanges(self):
+        # new cases of the last 24 hours, None while the history is shorter
+        return loadChanges()
+
+    def getMoversHTML(self):
+        return fragments.get('moversHTML', snapshotVersion('world'), self.renderMoversHTML)
+
+    def renderMoversHTML(self):
+        changes = loadChanges()
+        if changes is None:
+            return ''
+
+        top = changes.top(10)
+        columns = [[name for name, _ in top],
+                   ['+{:,}'.format(change['Confirmed']) for _, change in top],
+                   ['-' if change['Growth'] is None else '{:+.1%}'.format(change['Growth']) for _, change in top]]
+
+        with metrics.timer('stage_seconds', stage='table'):
+            return renderTable('movers', ['Country', 'New', 'Growth'], columns,
+                               {'text-align': 'center', 'border-color': 'black',
+                                'background-color': '#f7f1df', 'color': 'black'},
+                               '27pt')
+
+
+# try to format type shorter
+TYPE_PATTERN = re.compile(r'[0-9]{1}.{3}|[(]{1}.*?[)]{1}')
+
+
+class caseStore:
+    # merged view of an append-only log of rows keyed by number, where a
+    # later line for the same number replaces the earlier one and a line
+    # marked Deleted drops it
+
+    def __init__(self, path='files/cases.jsonl'):
+        self.path = path
+        self.rows = {}
+        self.lines = 0
+        self.offset = 0
+        self.inode = None
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def update(self):
+        # read only what was appended since the last call
+        with self.lock:
+            generation = readGeneration()
+            try:
+                fp = open(self.path, 'rb')
+            except FileNotFoundError:
+                return self.rows
+
+            with fp:
+                stat = os.fstat(fp.fileno())
+                # compacted, start over; an inode number alone can be reused
+                if (stat.st_ino != self.inode or generation != self.generation
+                        or stat.st_size < self.offset):
+                    self.reset(stat.st_ino, generation)
+
+                try:
+                    self.read(fp)
+                except ValueError:  # landed mid-line in a rewritten file
+                    self.reset(stat.st_ino, generation)
+                    self.read(fp)
+
+            return self.rows
+
+    def reset(self, inode, generation):
+        self.rows = {}
+        self.lines = 0
+        self.offset = 0
+        self.inode = inode
+        self.generation = generation
+
+    def read(self, fp):
+        fp.seek(self.offset)
+        for line in fp:
+            if not line.endswith(b'\n'):  # still being written
+                break
+            row = json.loads(line)
+            if row.get('Deleted'):
+                self.rows.pop(row['Number'], None)
+            else:
+                self.rows[row['Number']] = row
+            self.lines += 1
+            self.offset += len(line)
+
+
+def readGeneration():
+    # bumped by every compaction of files/cases.jsonl
+    try:
+        with open('files/casesGeneration.txt', 'r') as fp:
+            return fp.read()
+    except FileNotFoundError:
+        return ''
+
+
+caseLog = caseStore()
+# raw upstream fields of every stored case, to spot new, changed or removed ones
+caseRaw = caseStore('files/casesIndex.jsonl')
 
-        return total
+# rows of a /cases page unless asked otherwise
+CASES_PAGE_SIZE = 100
+
+
+class caseIndex:
+    # cases sorted newest first, with positions of every Origin, Type and Job value
+
+    filters = ['Origin', 'Type', 'Job']
+
+    def __init__(self):
+        rows = caseLog.update()
+        if not rows:  # no snapshot yet, never wait for upstream
+            refresher.kick('cases')
+
+        self.rows = sorted(({k: '-' if v is None else v for k, v in row.items()} for row in rows.values()),
+                           key=lambda row: row['Number'], reverse=True)
+        self.by = {field: {} for field in self.filters}
+        for pos, row in enumerate(self.rows):
+            for field, index in self.by.items():
+                index.setdefault(row[field], []).append(pos)
+
+        self.selected = {}
+        self.lock = threading.Lock()
+
+    def select(self, filters):
+        filters = {field: value for field, value in filters.items() if value}
+        if not filters:
+            return range(len(self.rows))
+
+        key = tuple(sorted(filters.items()))
+        positions = self.selected.get(key)
+        if positions is None:
+            lists = sorted((self.by[field].get(value, []) for field, value in filters.items()), key=len)
+            others = [set(l) for l in lists[1:]]
+            positions = [pos for pos in lists[0] if all(pos in other for other in others)]
+
+            with self.lock:
+                if len(self.selected) > 256:  # many odd combinations, start over
+                    self.selected = {}
+                self.selected[key] = positions
+
+        return positions
+
+    def page(self, page, size, filters):
+        positions = self.select(filters)
+        start = (page - 1) * size
+
+        return [self.rows[pos] for pos in positions[start:start + size]], len(positions)
 
 
 class cases:
 
-    def getCasesData(self):
-        url = "https://covid19.workpointnews.com/api/cases"
+    def parseCase(self, case):
+        return {'Number': case['number'],
+                'Job': case['job'],
+                'Origin': case['origin'],
+                'Type': '-' if case['type'] is None else TYPE_PATTERN.sub('', case['type'])}
 
-        json = parser(url)
+    def writeCases(self):
+        url = WORKPOINT_URL + "/api/cases"
 
-        data = {'Number': [], 'Job': [], 'Origin': [],
-                'Type': []}
+        json_cases = parser(url)
+
+        if not os.path.exists('files/cases.jsonl'):  # start both logs over
+            with atomicOpen('files/casesIndex.jsonl', 'w') as fp:
+                pass
+        index = caseRaw.update()
+
+        lines, raws = [], []
+        moved = {}  # province tally deltas
+        seen = set()
+        for case in json_cases:
+            number = case['number']
+            seen.add(number)
+            raw = [case['job'], case['origin'], case['type'], (case.get('province') or '').strip()]
+            old = index.get(number)
+            if old is not None and old['Raw'] == raw:
+                continue
 
-        for case in json:
-            data['Number'].append(case['number'])
-            data['Job'].append(case['job'])
-            data['Origin'].append(case['origin'])
+            if old is not None:
+                moved[old['Raw'][3]] = moved.get(old['Raw'][3], 0) - 1
+            moved[raw[3]] = moved.get(raw[3], 0) + 1
+            lines.append(json.dumps(self.parseCase(case), ensure_ascii=False) + '\n')
+            raws.append(json.dumps({'Number': number, 'Raw': raw}, ensure_ascii=False) + '\n')
+
+        # cases upstream took back, unless the list came back empty
+        if json_cases:
+            for number, old in index.items():
+                if number not in seen:
+                    moved[old['Raw'][3]] = moved.get(old['Raw'][3], 0) - 1
+                    tombstone = json.dumps({'Number': number, 'Deleted': True}) + '\n'
+                    lines.append(tombstone)
+                    raws.append(tombstone)
+
+        compacted = False
+        if lines:
+            # cases first, a crash before the index only appends them again
+            with open('files/cases.jsonl', 'a', encoding='utf-8') as fp:
+                fp.write(''.join(lines))
+            with open('files/casesIndex.jsonl', 'a', encoding='utf-8') as fp:
+                fp.write(''.join(raws))
+
+            compacted = self.compactCases()
+
+        # cases per province, for location replies; a compaction recounts them
+        if not os.path.exists('files/provinces.json'):
+            self.writeProvinceCases(self.countProvinces())
+        elif moved and not compacted:
+            provinces = self.readProvinceCases()
+            for province, delta in moved.items():
+                provinces[province] = provinces.get(province, 0) + delta
+            self.writeProvinceCases(provinces)
+
+        writeTimestamp('cases')
+
+    def compactCases(self):
+        # rewrite both logs once replaced or deleted lines outnumber the live ones
+        rows = caseLog.update()
+        if caseLog.lines <= 2 * len(rows):
+            return False
+
+        index = caseRaw.update()
+        with atomicOpen('files/cases.jsonl', 'w', encoding='utf-8') as fp:
+            for row in rows.values():
+                fp.write(json.dumps(row, ensure_ascii=False) + '\n')
+        with atomicOpen('files/casesIndex.jsonl', 'w', encoding='utf-8') as fp:
+            for row in index.values():
+                fp.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+        # after the swap, a reader seeing the old number reads again next time
+        with atomicOpen('files/casesGeneration.txt', 'w') as fp:
+            fp.write(str(time.time_ns()))
+
+        # recount from scratch now and then, in case a crash left the tally off
+        self.writeProvinceCases(self.countProvinces())
+        return True
+
+    def countProvinces(self):
+        provinces = {}
+        for row in caseRaw.update().values():
+            provinces[row['Raw'][3]] = provinces.get(row['Raw'][3], 0) + 1
+        return provinces
+
+    def writeProvinceCases(self, provinces):
+        provinces = {province: count for province, count in provinces.items() if province and count > 0}
+        with atomicOpen('files/provinces.json', 'w', encoding='utf-8') as fp:
+            json.dump(provinces, fp, ensure_ascii=False)
 
-            if case['type'] == None:
-                data['Type'].append('-')
-            else:
-                # try to format type shorter
-                p = re.compile(r'[0-9]{1}.{3}|[(]{1}.*?[)]{1}')
-                data['Type'].append(p.sub('', case['type']))
+    def getCasesData(self):
+        import pandas as pd
+        rows = caseLog.update()
+        if not rows:  # no snapshot yet, never wait for upstream
+            refresher.kick('cases')
+            return pd.DataFrame(columns=COLUMNS['cases'])
 
-        df = pd.DataFrame(data)  # convert to a dataframe
+        return pd.DataFrame(list(rows.values()), columns=COLUMNS['cases'])
 
-        return df
+    def getProvinceCases(self):
+        return fragments.get('provinceCases', snapshotVersion('cases'), self.readProvinceCases)
 
-    def getCasesHTML(self):
+    def readProvinceCases(self):
         try:
-            # get a timestamp of lastUpdate data
-            with open('files/casesLastUpdate.txt', 'r') as fp:
-                timestamp = fp.read()
+            with open('files/provinces.json', 'r', encoding='utf-8') as fp:
+                return json.load(fp)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):  # not fetched yet
+            return {}
 
-            now = datetime.utcnow()
-            lastUpdate = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
-            differ = now - lastUpdate
+    def getCasesPage(self, page=1, size=CASES_PAGE_SIZE, filters=None):
+        # rows of one page, newest first, and how many cases match
+        index = stores.get('caseIndex', snapshotVersion('cases'), caseIndex)
 
-            # write new dataframe when more than 15 mins
-            if differ.seconds > 15 * 60:
-                writeCSV('cases')  # timestamp get update in here
+        return index.page(page, size, filters or {})
 
-            # read csv to get data
-            df = pd.read_csv('files/cases.csv', index_col=False)
+    def getCasesHTML(self, page=1, size=CASES_PAGE_SIZE, filters=None):
+        if page == 1 and size == CASES_PAGE_SIZE and not filters:
+            return fragments.get('casesHTML', snapshotVersion('cases'), self.renderCasesHTML)
 
-        except FileNotFoundError:  # write new if not found
-            writeCSV('cases')  # timestamp get update in here
-            df = pd.read_csv('files/cases.csv', index_col=False)
+        return self.renderCasesHTML(page, size, filters)
 
-        df = df.fillna('-')  # fill na with blank instead
-        # Sort by Confirmed Cases
-        df.sort_values(by='Number', ascending=False,
-                       inplace=True, ignore_index=True)
+    def renderCasesHTML(self, page=1, size=CASES_PAGE_SIZE, filters=None):
+        # only the rows of this page, the scheduler keeps the cases fresh
+        rows, _ = self.getCasesPage(page, size, filters)
+        columns = [[row[col] for row in rows] for col in COLUMNS['cases']]
 
-        # set style
-        fontSize = '20pt'
-        df = df.style.set_properties(**{'text-align': 'center',
-                                        'border-color': 'green',
-                                        'font-size': fontSize,
-                                        'background-color': '#fdfff7',
-                                        'color': 'black'})\
-            .set_table_styles([{'selector': 'th', 'props': [('font-size', fontSize)]}])\
+        with metrics.timer('stage_seconds', stage='table'):
+            return renderTable('cases', COLUMNS['cases'], columns,
+                               {'text-align': 'center', 'border-color': 'green',
+                                'background-color': '#fdfff7', 'color': 'black'},
+                               '20pt')
 
+    def writeConstantsJSON(self):
+        thai_json = parser(WORKPOINT_URL + "/api/constants")
 
-        return df.hide_index().render()
+        with atomicOpen('files/constants.json', 'w', encoding='utf-8') as fp:
+            json.dump(thai_json, fp, ensure_ascii=False)
+
+        writeTimestamp('constants')
 
     def getCasesSummary(self):
+        return fragments.get('casesSummary', snapshotVersion('constants'), self.computeCasesSummary)
+
+    def computeCasesSummary(self):
         # Summary of Thailand
-        thai_json = parser("https://covid19.workpointnews.com/api/constants")
+        try:
+            with open('files/constants.json', 'r', encoding='utf-8') as fp:
+                thai_json = json.load(fp)
+        except FileNotFoundError:  # no snapshot yet
+            refresher.kick('constants')
+            thai_json = {}
 
         data = {}
-        data['recovered'] = thai_json['หายแล้ว']
-        data['death'] = thai_json['เสียชีวิต']
-        data['added'] = thai_json['เพิ่มวันนี้']
-        data['hospitolized'] = thai_json['กำลังรักษา']
-        data['confirmed'] = thai_json['ผู้ติดเชื้อ']
+        data['recovered'] = thai_json.get('หายแล้ว', '-')
+        data['death'] = thai_json.get('เสียชีวิต', '-')
+        data['added'] = thai_json.get('เพิ่มวันนี้', '-')
+        data['hospitolized'] = thai_json.get('กำลังรักษา', '-')
+        data['confirmed'] = thai_json.get('ผู้ติดเชื้อ', '-')
 
         return data
 
 
-class country:
-    def writeCountryTimeSeries(self):
-        url = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_19-covid-Confirmed.csv'
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        req = Request(url, headers=headers)
+class subscriberStore:
+    # files/subscribers.jsonl, one line per follow or unfollow event,
+    # the last line of a user decides whether they get the daily push
 
-        # open up connection, grap the page
-        uClient = urlopen(req)
-        page_csv = uClient.read().decode('utf-8').replace('Korea, South',
-                                                          'South Korea').replace('Taiwan*', 'Taiwan').replace('US', 'United States')
+    def __init__(self, path='files/subscribers.jsonl'):
+        self.path = path
+        self.lock = threading.Lock()
 
-        uClient.close()  # close connection
+    def record(self, userId, following):
+        line = json.dumps({'user': userId, 'follow': following}) + '\n'
 
-        now = datetime.utcnow()
+        # appends of a single line stay whole across gunicorn processes
+        with self.lock, open(self.path, 'a') as fp:
+            fp.write(line)
 
-        # try to get timestamp of the last update
+    def load(self):
+        # user ids in the order they followed
+        users = OrderedDict()
         try:
-            # write a timestamp of last get data
-            with open('files/timeSeriesLastUpdate.txt', 'r') as fp:
-                timestamp = fp.read()
+            with open(self.path, 'r') as fp:
+                for line in fp:
+                    entry = json.loads(line)
+                    users.pop(entry['user'], None)
+                    if entry['follow']:
+                        users[entry['user']] = True
+        except FileNotFoundError:  # nobody followed yet
+            pass
+
+        return list(users)
+
+
+subscribers = subscriberStore()
+
+
+def buildTimeSeries(page_csv):
+    import numpy as np
+    import pandas as pd
+    # one row per country, provinces summed, as a matrix of countries x dates
+    df = pd.read_csv(StringIO(page_csv))
+    df = df.drop(columns=['Province/State', 'Lat', 'Long'])
+    df = df.groupby('Country/Region').sum()
+
+    with atomicOpen('files/timeseries.npy', 'wb') as fp:
+        np.save(fp, df.to_numpy(dtype=np.int64))
+
+    index = {'dates': [str(d.date()) for d in pd.to_datetime(df.columns)],
+             'countries': {name: row for row, name in enumerate(df.index)}}
+    with atomicOpen('files/timeseriesIndex.json', 'w') as fp:
+        json.dump(index, fp)
+
+
+class timeSeriesStore:
+    # memory-mapped matrix of the time series, one lookup per country
+
+    def __init__(self):
+        import numpy as np
+        import pandas as pd
+        with open('files/timeseriesIndex.json', 'r') as fp:
+            index = json.load(fp)
+
+        self.matrix = np.load('files/timeseries.npy', mmap_mode='r')
+        self.countries = index['countries']
+        self.dates = pd.to_datetime(index['dates'])
+
+    def get(self, country):
+        return self.matrix[self.countries[country]]  # KeyError when unknown
+
+
+def loadTimeSeries():
+    try:
+        return stores.get('timeSeries', seriesVersion(), timeSeriesStore)
+    except FileNotFoundError:
+        try:  # csv from before the store existed
             with open('files/timeseries.csv', 'r') as fp:
-                pass
-        except FileNotFoundError:  # never init any timeSeries file
-            with open('files/timeSeriesLastUpdate.txt', 'w') as fp:
-                fp.write(str(now))
-                timestamp = str(now)
-            with open('files/timeseries.csv', 'w') as fp:
-                fp.write(page_csv)
-
-        lastUpdate = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
-        differ = now - lastUpdate
-
-        # write new dataframe when more than 1 hour
-        if differ.seconds > 60 * 60 * 1:
-            with open('files/timeseries.csv', 'w') as fp:
-                fp.write(page_csv)
-            with open('files/timeSeriesLastUpdate.txt', 'w') as fp:
-                fp.write(str(now))
+                buildTimeSeries(fp.read())
+        except FileNotFoundError:  # never fetched, not found for now
+            refresher.kick('timeSeries')
+            raise KeyError('timeSeries')
 
-    def getCountryPlot(self, country):
+        return stores.get('timeSeries', seriesVersion(), timeSeriesStore)
 
-        # Caplitalize country params from url
-        country = capwords(country)
 
-        try:
-            df = pd.read_csv('files/timeseries.csv', index_col=1)
-        except FileNotFoundError:
-            self.writeCountryTimeSeries()
-            df = pd.read_csv('files/timeseries.csv', index_col=1)
-
-        df = df.drop(columns=['Province/State', 'Lat', 'Long'])
-
-        try:  # country appear only 1 in df
-            ct = df.loc[country, :].to_frame()
-            ct.index.name = 'Date'
-            ct = ct.reset_index()
-            ct['Date'] = pd.to_datetime(ct['Date'])
-            date = ct['Date'].to_list()
-            case = ct[country].to_list()
-
-        except AttributeError:  # appear more than 1
-            ct = df.loc[country, :]
-            ct = ct.reset_index()
-
-            aggregation_functions = {}
-            for col in ct.columns[1:]:
-                aggregation_functions[col] = 'sum'
-            ct = ct.groupby(ct['Country/Region']
-                            ).aggregate(aggregation_functions)
-
-            date = pd.to_datetime(ct.columns)
-            case = ct.loc[country, :].to_list()
-
-        fig, ax = plt.subplots(figsize=(9, 8))
-        ax.plot(date, case, linewidth=5)
-        plt.xticks(fontsize=18)
-        plt.yticks(fontsize=18)
-
-        # format the Date axis
-        locator = mdates.AutoDateLocator()
-        formatter = mdates.ConciseDateFormatter(locator)
-        ax.xaxis.set_major_locator(locator)
-        ax.xaxis.set_major_formatter(formatter)
-
-        # save to html
-        tmp = BytesIO()
-        plt.savefig(tmp, format='png')
-        encoded = base64.b64encode(tmp.getvalue()).decode('ascii')
+def normalize(name):
+    return ' '.join(name.replace('-', ' ').replace('_', ' ').lower().split())
 
-        return encoded
 
-    def getCountryData(self, country):
-        try:
-            allDF = pd.read_csv('files/world.csv', index_col=0)
-        except FileNotFoundError:
-            writeCSV('world')
-            allDF = pd.read_csv('files/world.csv', index_col=0)
+class countryIndex:
+    # every known spelling of a country -> one canonical key (ISO3 when there is one)
 
-        country = capwords(country)
+    def __init__(self):
+        self.keys = {}
+        self.world = {}  # canonical -> name in the world snapshot
+        self.series = {}  # canonical -> name in the time series
+        self.emoji = {}  # canonical -> label of the country menu
 
-        # select only row of country
-        df = allDF.loc[country, ['Confirmed', 'Recovered', 'Death']]
+        worldNames = list(loadWorld().rows)
+        try:
+            seriesNames = list(loadTimeSeries().countries)
+        except KeyError:  # no time series yet
+            seriesNames = []
 
-        return df.to_list()
+        # resolve every new name in one batch
+        iso3Codes.convert(worldNames + seriesNames)
 
-    def getEmojiName(self, country):
-        country = capwords(country)
+        for name in worldNames:
+            self.world[self.add(name)] = name
+        for name in seriesNames:
+            self.series[self.add(name)] = name
 
-        # get emoji
+        # emoji labels of the country menu, e.g. "🇹🇭 Thailand"
         try:
             with open('permanentfiles/country.json', 'r') as fp:
                 data = json.load(fp)
-
             for c in data['body']['contents']:
-                emojiName = c['action']['label']
-                print(emojiName)
-                if country in emojiName:  # found our emoji name
-                    return emojiName
-            return country
-        except Exception:
-            return country
+                label = c['action']['label']
+                key = self.add(re.sub(r'^[^A-Za-z]+|[^A-Za-z)]+$', '', label))
+                self.emoji[key] = label
+                self.keys.setdefault(normalize(label), key)
+        except (FileNotFoundError, KeyError, json.decoder.JSONDecodeError):
+            pass
+
+        # hand written aliases, Thai names and such: {"ญี่ปุ่น": "Japan"}
+        try:
+            with open('permanentfiles/countryAlias.json', 'r', encoding='utf-8') as fp:
+                for alias, name in json.load(fp).items():
+                    self.keys.setdefault(normalize(alias), self.canonical(name))
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            pass
+
+        # official names, short names and ISO codes from country_converter
+        for name, code in list(iso3Codes.index.items()):
+            if code in self.world or code in self.series:
+                self.keys.setdefault(normalize(name), code)
+
+    def canonical(self, name):
+        code = iso3Codes.convert([name])[0]
+        return code if re.fullmatch(r'[A-Z]{3}', str(code)) else name
+
+    def add(self, name):
+        key = self.canonical(name)
+        self.keys[normalize(name)] = key
+        return key
+
+    def resolve(self, name, fuzzy=True):
+        key = normalize(name)
+        if key in self.keys:
+            return self.keys[key]
+
+        if fuzzy:  # typos, e.g. "phillipines"
+            match = get_close_matches(key, self.keys, n=1, cutoff=0.85)
+            if match:
+                return self.keys[match[0]]
+
+        return None
+
+
+names = versionedCache()
+
+
+def loadCountryIndex():
+    version = (snapshotVersion('world'), seriesVersion(),
+               fileVersion('permanentfiles/country.json'))
+    return names.get('countryIndex', version, countryIndex)
+
+
+# testing hospitals, a list of {"name", "province", "lat", "lng", "phone"}
+FACILITIES = 'permanentfiles/hospitals.json'
+FACILITY_CELL = 0.5  # degrees per side of a grid cell
+FACILITY_RADIUS = float(os.environ.get('FACILITY_RADIUS', 200))  # km searched around a location
+KM_PER_DEGREE = 111.195
+
+
+def distanceKm(lat1, lng1, lat2, lng2):
+    # haversine
+    lat1, lng1, lat2, lng2 = map(math.radians, [lat1, lng1, lat2, lng2])
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+
+class facilityIndex:
+    # facilities bucketed in a grid of FACILITY_CELL degrees, a lookup only
+    # measures the ones in the cells around the location
+
+    def __init__(self):
+        try:
+            with open(FACILITIES, 'r', encoding='utf-8') as fp:
+                facilities = json.load(fp)
+        except FileNotFoundError:  # no dataset deployed
+            facilities = []
+
+        self.facilities = [f for f in facilities if f.get('lat') is not None and f.get('lng') is not None]
+        self.cells = {}
+        for i, facility in enumerate(self.facilities):
+            self.cells.setdefault(self.cell(facility['lat'], facility['lng']), []).append(i)
+
+    def cell(self, lat, lng):
+        return int(math.floor(lat / FACILITY_CELL)), int(math.floor(lng / FACILITY_CELL))
+
+    def ring(self, row, col, ring):
+        # cells exactly ring steps away from (row, col)
+        if ring == 0:
+            yield row, col
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield row - ring, c
+            yield row + ring, c
+        for r in range(row - ring + 1, row + ring):
+            yield r, col - ring
+            yield r, col + ring
+
+    def nearest(self, lat, lng, count=5):
+        # [(facility, km)] closest first, within FACILITY_RADIUS
+        row, col = self.cell(lat, lng)
+        rings = int(math.ceil(FACILITY_RADIUS / (FACILITY_CELL * KM_PER_DEGREE))) + 1
+
+        found = []
+        for ring in range(rings + 1):
+            for cell in self.ring(row, col, ring):
+                for i in self.cells.get(cell, ()):
+                    f = self.facilities[i]
+                    km = distanceKm(lat, lng, f['lat'], f['lng'])
+                    if km <= FACILITY_RADIUS:
+                        found.append((km, i))
+
+            found = sorted(found)[:count]
+
+            # cells further out are at least ring cells away
+            reach = ring * FACILITY_CELL * KM_PER_DEGREE * math.cos(
+                math.radians(min(89, abs(lat) + (ring + 1) * FACILITY_CELL)))
+            if len(found) == count and found[-1][0] <= reach:
+                break
+
+        return [(self.facilities[i], km) for km, i in found]
+
+
+def loadFacilities():
+    return stores.get('facilities', fileVersion(FACILITIES), facilityIndex)
+
+
+def snapshotAges():
+    ages = {}
+    for mode in scheduler.intervals:
+        version = snapshotVersion(mode)
+        if version:
+            ages[mode] = time.time() - version / 1e9
+
+    return ages
+
+
+caches = {'fragments': fragments, 'plots': plots, 'stores': stores, 'names': names}
+metrics.collect('cache_hits_total', 'counter', 'cache',
+                lambda: {name: cache.hits for name, cache in caches.items()})
+metrics.collect('cache_misses_total', 'counter', 'cache',
+                lambda: {name: cache.misses for name, cache in caches.items()})
+metrics.collect('snapshot_age_seconds', 'gauge', 'snapshot', snapshotAges)
+
+
+def renderTimedOut(signum, frame):
+    raise TimeoutError('render timed out')
+
+
+def renderCountryPlotJob(name, timeout):
+    # runs in a render process, which times out its own render so a stuck
+    # one never takes the renders of other processes down with it
+    signal.signal(signal.SIGALRM, renderTimedOut)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    # stuck in C code the handler never runs, SIGPROF then ends the process
+    signal.setitimer(signal.ITIMER_PROF, timeout + RENDER_GRACE)
+    try:
+        return country().renderCountryPlot(name)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.setitimer(signal.ITIMER_PROF, 0)
+
+
+# seconds of cpu past the timeout before a render process is killed
+RENDER_GRACE = 5
+
+
+class renderPool:
+    # matplotlib runs in its own processes, away from the web threads and the GIL
+
+    def __init__(self):
+        self.processes = int(os.environ.get('RENDER_PROCESSES', 2))
+        self.timeout = float(os.environ.get('RENDER_TIMEOUT', 20))
+        # renders running or waiting, more than that are turned away
+        self.slots = threading.BoundedSemaphore(int(os.environ.get('RENDER_QUEUE', 16)))
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def executor(self):
+        # started on first use, after gunicorn has forked its workers
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.processes,
+                                                mp_context=multiprocessing.get_context('forkserver'))
+            return self.pool
+
+    def restart(self, pool):
+        # a killed process breaks its pool, renders after it go to a new one
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False)
+
+    def render(self, name):
+        if not self.slots.acquire(blocking=False):
+            metrics.inc('errors_total', where='render_queue_full')
+            raise TimeoutError('render queue full')
+
+        try:
+            for attempt in range(2):
+                pool = self.executor()
+                try:
+                    return pool.submit(renderCountryPlotJob, name, self.timeout).result()
+                except TimeoutError:
+                    metrics.inc('errors_total', where='render_timeout')
+                    raise TimeoutError('render of {} timed out'.format(name))
+                except BrokenProcessPool:
+                    # maybe another render was killed, try once more on fresh processes
+                    metrics.inc('errors_total', where='render_crash')
+                    self.restart(pool)
+                    if attempt:
+                        raise
+        finally:
+            self.slots.release()
+
+
+renderer = renderPool()
+
+
+class country:
+    def writeCountryTimeSeries(self):
+        url = CSSE_URL + '/csse_covid_19_data/csse_covid_19_time_series/time_series_19-covid-Confirmed.csv'
+        headers = {}
+
+        # only download when GitHub has something newer than our copy
+        try:
+            with open('files/timeSeriesHeaders.json', 'r') as fp:
+                validators = json.load(fp)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            validators = {}
+        if os.path.exists('files/timeseries.npy'):
+            if 'ETag' in validators:
+                headers['If-None-Match'] = validators['ETag']
+            if 'Last-Modified' in validators:
+                headers['If-Modified-Since'] = validators['Last-Modified']
+
+        # grap the page over a pooled connection
+        response = fetch(url, headers)
+        if response.status_code == 304:  # not modified, still fresh
+            writeTimestamp('timeSeries')
+            return
+
+        page_csv = response.content.decode('utf-8').replace('Korea, South',
+                                                            'South Korea').replace('Taiwan*', 'Taiwan').replace('US', 'United States')
+        validators = {name: response.headers[name] for name in ['ETag', 'Last-Modified']
+                      if name in response.headers}
+
+        with atomicOpen('files/timeseries.csv', 'w') as fp:
+            fp.write(page_csv)
+        buildTimeSeries(page_csv)
+
+        with atomicOpen('files/timeSeriesHeaders.json', 'w') as fp:
+            json.dump(validators, fp)
+
+        writeTimestamp('timeSeries')
+
+    def getCountryPlot(self, country):
+        # name from url to the time series row
+        index = loadCountryIndex()
+        country = index.series[index.resolve(country)]  # KeyError when unknown
+
+        key = (country, seriesVersion())
+        encoded = plots.get(key)
+        if encoded is None:
+            encoded = renderer.render(country)
+            plots.put(key, encoded)
+
+        return encoded
+
+    def renderCountryPlot(self, country):
+        store = loadTimeSeries()
+
+        return renderPlot(store.dates, store.get(country))
+
+    def getCountrySeries(self, country, points=None):
+        import numpy as np
+        # cumulative cases as a start date, a day step and deltas,
+        # every step-th day counting back from the latest one
+        index = loadCountryIndex()
+        country = index.series[index.resolve(country)]  # KeyError when unknown
+
+        store = loadTimeSeries()
+        values = np.asarray(store.get(country))
+        if len(values) == 0:
+            raise KeyError(country)
+
+        step = 1
+        if points and 0 < points < len(values):
+            step = -(-len(values) // points)  # ceil
+        picked = np.arange(len(values) - 1, -1, -step)[::-1]
+        values = values[picked]
+
+        return {'country': country,
+                'start': str(store.dates[picked[0]].date()),
+                'step': int(step),
+                'first': int(values[0]),
+                'deltas': np.diff(values).tolist()}
+
+    def getCountryData(self, country):
+        index = loadCountryIndex()
+        country = index.world[index.resolve(country)]  # KeyError when unknown
+
+        # select only row of country
+        return loadWorld().get(country)
+
+    def getCountryChanges(self, country):
+        # new cases of the last 24 hours, None without enough history
+        index = loadCountryIndex()
+        country = index.world[index.resolve(country)]  # KeyError when unknown
+
+        changes = loadChanges()
+        return None if changes is None else changes.get(country)
+
+    def getEmojiName(self, country):
+        index = loadCountryIndex()
+
+        return index.emoji.get(index.resolve(country), capwords(country))
+
+
+# the posts array inside the page's <script type="application/json">
+NEWS_MARKER = re.compile(r'"ssrLiveUpdatePosts"\s*:\s*')
+NEWS_CHUNK = 16 * 1024
+JSON_STRUCTURE = re.compile(r'[][{}"]')
+JSON_STRING = re.compile(r'["\\]')
+
+
+class jsonScanner:
+    # finds where the JSON value at the start of a growing buffer ends,
+    # looking at every character once however many chunks it comes in
+
+    def __init__(self):
+        self.pos = 0
+        self.depth = 0
+        self.inString = False
+
+    def end(self, buffer):
+        while True:
+            if self.inString:
+                match = JSON_STRING.search(buffer, self.pos)
+                if match is None:
+                    self.pos = len(buffer)
+                    return None
+                if match.group() == '\\':
+                    if match.end() == len(buffer):  # escaped character in the next chunk
+                        self.pos = match.start()
+                        return None
+                    self.pos = match.end() + 1
+                    continue
+                self.inString = False
+            else:
+                match = JSON_STRUCTURE.search(buffer, self.pos)
+                if match is None:
+                    self.pos = len(buffer)
+                    return None
+                if match.group() == '"':
+                    self.inString = True
+                elif match.group() in '[{':
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        return match.end()
+            self.pos = match.end()
 
 
 class news:
     def newsParser(self):
-        url = "https://covid19.workpointnews.com/live-update"
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        req = Request(url, headers=headers)
+        url = WORKPOINT_URL + "/live-update"
+
+        # stream the page and stop as soon as the posts are complete,
+        # the rest of the document is never downloaded or parsed
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        buffer = ''
+        found = False
+        scanner = jsonScanner()
+
+        with fetch(url, stream=True) as response:
+            for chunk in response.iter_content(NEWS_CHUNK):
+                buffer += decoder.decode(chunk)
 
-        # open up connection, grap the page
-        uClient = urlopen(req)
-        page_html = uClient.read()
-        uClient.close()  # close connection
+                if not found:
+                    marker = NEWS_MARKER.search(buffer)
+                    if marker is None:
+                        # keep just enough to catch a marker split over chunks
+                        buffer = buffer[-64:]
+                        continue
+                    buffer = buffer[marker.end():]
+                    found = True
 
-        # html parsing
-        pageSoup = soup(page_html, "html.parser")
-        return pageSoup
+                end = scanner.end(buffer)
+                if end is None:  # array not complete yet
+                    continue
 
-    def getNewsData(self):
-        pageSoup = self.newsParser()
+                return json.loads(buffer[:end])
 
-        jsonScript = json.loads(pageSoup.find(
-            'script', type='application/json').text)
+        raise ValueError('no ssrLiveUpdatePosts in ' + url)
 
-        news = jsonScript['props']['pageProps']['ssrLiveUpdatePosts']
+    def getNewsData(self, posts=None):
+        if posts is None:
+            posts = self.newsParser()
 
         data = {}
 
-        for new in news:
-            p = re.compile(r'&#[0-9]{4};')
+        p = re.compile(r'&#[0-9]{4};')
+        for new in posts:
             data[p.sub(' ', new['title'])] = [
                 new['link'], new['cover']['medium']]
 
         return data
 
     def writeNewsJSON(self):
+        posts = self.newsParser()
 
-        # write new timestamp
-        with open('files/newsLastUpdate.txt', 'w') as fp:
-            fp.write(str(datetime.utcnow()))
+        # same posts as last time, only the timestamp moves
+        ids = [new.get('id', new['link']) for new in posts]
+        try:
+            with open('files/newsIds.json', 'r') as fp:
+                unchanged = json.load(fp) == ids and os.path.exists('files/news.json')
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            unchanged = False
+
+        if unchanged:
+            writeTimestamp('news')
+            return
 
         # write new JSON
         flex = {
@@ -458,7 +1796,7 @@ class news:
             }
         }
 
-        data = self.getNewsData()
+        data = self.getNewsData(posts)
 
         for new in data:
             title = new
@@ -514,33 +1852,38 @@ class news:
 
         # end loop
         # write to JSON file
-        with open('files/news.json', 'w', encoding='utf-8') as fp:
+        with atomicOpen('files/news.json', 'w', encoding='utf-8') as fp:
             json.dump(flex, fp, ensure_ascii=False, indent=4)
 
-    def getNewsJSON(self):
-        try:
-            # read a timestamp of last get data
-            with open('files/newsLastUpdate.txt', 'r') as fp:
-                timestamp = fp.read()
-
-            now = datetime.utcnow()
-            lastUpdate = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
-            differ = now - lastUpdate
+        with atomicOpen('files/newsIds.json', 'w') as fp:
+            json.dump(ids, fp)
 
-            #  write again if more than 30 mins
-            if differ.seconds > 30 * 60:
-                self.writeNewsJSON()
+        # write new timestamp
+        writeTimestamp('news')
 
+    def getNewsJSON(self):
+        try:
+            # read the last snapshot, the scheduler keeps it fresh
             with open('files/news.json', 'r') as fp:
                 newsJSON = json.load(fp)
 
             return newsJSON
 
-        except FileNotFoundError or json.decoder.JSONDecodeError:  # not found file
-            print('got here??')
-            self.writeNewsJSON()  # write again
-
-            with open('files/news.json', 'r') as fp:
-                newsJSON = json.load(fp)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):  # not fetched yet
+            refresher.kick('news')
 
-            return newsJSON
+            return {
+                "type": "bubble",
+                "body": {
+                    "type": "box",
+                    "layout": "vertical",
+                    "contents": [
+                        {
+                            "type": "text",
+                            "text": "กำลังอัปเดตข่าว ลองใหม่อีกครั้ง",
+                            "align": "center",
+                            "wrap": True
+                        }
+                    ]
+                }
+            }
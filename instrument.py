@@ -0,0 +1,92 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+# upper bounds in seconds of the latency histograms
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+
+class registry:
+    # in-process metrics, rendered in the Prometheus text format
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  # name -> {labels: [bucket counts..., +Inf, sum, count]}
+        self.counters = {}  # name -> {labels: value}
+        self.collectors = []  # (name, type, label, fn returning {label value: value})
+
+    def observe(self, name, seconds, **labels):
+        labels = tuple(sorted(labels.items()))
+
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            values = series.get(labels)
+            if values is None:
+                values = series[labels] = [0] * (len(BUCKETS) + 3)
+
+            values[bisect.bisect_left(BUCKETS, seconds)] += 1
+            values[-2] += seconds
+            values[-1] += 1
+
+    def inc(self, name, value=1, **labels):
+        labels = tuple(sorted(labels.items()))
+
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def collect(self, name, kind, label, fn):
+        # values read at scrape time, e.g. cache counters or snapshot ages
+        self.collectors.append((name, kind, label, fn))
+
+    def render(self):
+        lines = []
+
+        with self.lock:
+            for name, series in sorted(self.histograms.items()):
+                lines.append('# TYPE {} histogram'.format(name))
+                for labels, values in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ['+Inf'], values):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(
+                            name, formatLabels(labels + (('le', bound),)), cumulative))
+                    lines.append('{}_sum{} {}'.format(name, formatLabels(labels), values[-2]))
+                    lines.append('{}_count{} {}'.format(name, formatLabels(labels), values[-1]))
+
+            for name, series in sorted(self.counters.items()):
+                lines.append('# TYPE {} counter'.format(name))
+                for labels, value in sorted(series.items()):
+                    lines.append('{}{} {}'.format(name, formatLabels(labels), value))
+
+        # several collectors may feed the same metric, e.g. cache counters
+        collected = {}
+        for name, kind, label, fn in self.collectors:
+            collected.setdefault((name, kind), []).extend(
+                ((label, key), value) for key, value in fn().items())
+
+        for (name, kind), series in sorted(collected.items()):
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in sorted(series):
+                lines.append('{}{} {}'.format(name, formatLabels((labels,)), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = registry()
@@ -0,0 +1,232 @@
+# Send the daily summary to every follower of the bot with LINE multicast.
+#
+#   python push.py             send today's summary, or finish today's run if it was cut short
+#   python push.py --dry-run   build the message and count the recipients, send nothing
+#
+# LINE_API_ENDPOINT=http://127.0.0.1:8000 sends to a local stand-in of the Messaging API.
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+from datetime import date
+
+import requests
+
+# the push reads the snapshots in files/, it never refreshes on its own
+os.environ['SCHEDULER'] = '0'
+
+import app as site
+from helper import cases, world, subscribers, singleFlight, atomicOpen
+from linebot.models import FlexSendMessage
+from linebot.exceptions import LineBotApiError
+
+
+MULTICAST_LIMIT = 500  # user ids per request, the API maximum
+RETRIES = 5
+PROGRESS = 'files/push.json'  # {"run", "done", "total"} of the last run
+RECIPIENTS = 'files/pushRecipients.json'  # followers when the run started
+
+
+class tokenBucket:
+    # at most rate requests per second on average, bursts of up to burst
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+
+def formatCount(value):
+    return '{:,}'.format(value) if isinstance(value, int) else str(value)
+
+
+def summaryRow(label, value, colour):
+    return {
+        "type": "box",
+        "layout": "horizontal",
+        "contents": [
+            {
+                "type": "text",
+                "text": label,
+                "size": "md",
+                "color": colour,
+                "weight": "bold",
+                "flex": 3
+            },
+            {
+                "type": "text",
+                "text": formatCount(value),
+                "size": "md",
+                "align": "end",
+                "flex": 4
+            }
+        ]
+    }
+
+
+def summaryFlex(day):
+    # one message for the whole run, every batch sends the same object
+    thai = cases().getCasesSummary()
+    total = world().getWorldTotal()
+
+    bubble = {
+        "type": "bubble",
+        "header": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": "COVID-19",
+                    "size": "xxl",
+                    "weight": "bold",
+                    "align": "center"
+                },
+                {
+                    "type": "text",
+                    "text": day,
+                    "size": "sm",
+                    "align": "center"
+                }
+            ]
+        },
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "spacing": "sm",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": "ประเทศไทย",
+                    "size": "lg",
+                    "weight": "bold"
+                },
+                summaryRow("ผู้ติดเชื้อ", thai['confirmed'], "#227700"),
+                summaryRow("เพิ่มวันนี้", thai['added'], "#0fa348"),
+                summaryRow("หายแล้ว", thai['recovered'], "#90c451"),
+                summaryRow("เสียชีวิต", thai['death'], "#ff4f4f"),
+                {
+                    "type": "separator",
+                    "margin": "md"
+                },
+                {
+                    "type": "text",
+                    "text": "ทั่วโลก",
+                    "size": "lg",
+                    "weight": "bold",
+                    "margin": "md"
+                },
+                summaryRow("ผู้ติดเชื้อ", total['Confirmed'], "#227700"),
+                summaryRow("หายแล้ว", total['Recovered'], "#90c451"),
+                summaryRow("เสียชีวิต", total['Death'], "#ff4f4f")
+            ]
+        },
+        "styles": {
+            "header": {
+                "backgroundColor": "#fae1be"
+            },
+            "body": {
+                "backgroundColor": "#fff1de"
+            }
+        }
+    }
+
+    return FlexSendMessage(alt_text='สรุปสถานการณ์ COVID-19 {}'.format(day), contents=bubble)
+
+
+def multicast(api, to, message, bucket, retryKey):
+    # the retry key makes LINE drop a batch it already accepted, also
+    # across a crash and a resumed run
+    for attempt in range(RETRIES + 1):
+        bucket.take()
+        try:
+            api.multicast(to, message, retry_key=retryKey)
+            return
+        except LineBotApiError as e:
+            if e.status_code == 409:  # accepted by an earlier attempt
+                return
+            if (e.status_code != 429 and e.status_code < 500) or attempt == RETRIES:
+                raise
+            wait = float(e.headers.get('Retry-After', 2 ** attempt))
+        except requests.RequestException:
+            if attempt == RETRIES:
+                raise
+            wait = 2 ** attempt
+
+        print('multicast failed, retrying in {:.0f} s'.format(wait))
+        time.sleep(wait)
+
+
+def loadRun(run):
+    try:
+        with open(PROGRESS, 'r') as fp:
+            progress = json.load(fp)
+        if progress['run'] == run:
+            with open(RECIPIENTS, 'r') as fp:
+                return progress, json.load(fp)
+    except (FileNotFoundError, json.decoder.JSONDecodeError, KeyError):
+        pass
+
+    # a new run, freeze the followers so a resumed run sends the same batches
+    recipients = subscribers.load()
+    with atomicOpen(RECIPIENTS, 'w') as fp:
+        json.dump(recipients, fp)
+
+    return {'run': run, 'done': 0, 'total': len(recipients)}, recipients
+
+
+def main():
+    args = argparse.ArgumentParser(description='Send the daily summary to every follower')
+    args.add_argument('--run', default=date.today().isoformat(), help='run id, a finished run is not sent again')
+    args.add_argument('--rate', type=float, default=10, help='multicast requests per second')
+    args.add_argument('--batch', type=int, default=MULTICAST_LIMIT, help='user ids per request')
+    args.add_argument('--dry-run', action='store_true', help='print the message, send nothing')
+    args = args.parse_args()
+
+    if args.dry_run:
+        print(json.dumps(summaryFlex(args.run).as_json_dict(), ensure_ascii=False, indent=4))
+        print('{} subscribers'.format(len(subscribers.load())))
+        return
+
+    with singleFlight('push') as acquired:
+        if not acquired:
+            sys.exit('another push is running')
+
+        progress, recipients = loadRun(args.run)
+        if progress['done'] >= progress['total']:
+            print('run {} already sent to {} subscribers'.format(args.run, progress['total']))
+            return
+
+        site.lineClients()
+        message = summaryFlex(args.run)
+        bucket = tokenBucket(args.rate, max(1, args.rate))
+        batch = min(args.batch, MULTICAST_LIMIT)
+
+        for start in range(progress['done'], progress['total'], batch):
+            to = recipients[start:start + batch]
+            retryKey = str(uuid.uuid5(uuid.NAMESPACE_URL, 'push/{}/{}'.format(args.run, start)))
+            multicast(site.line_bot_api, to, message, bucket, retryKey)
+
+            progress['done'] = start + len(to)
+            with atomicOpen(PROGRESS, 'w') as fp:
+                json.dump(progress, fp)
+
+        print('sent run {} to {} subscribers'.format(args.run, progress['total']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
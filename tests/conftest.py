@@ -0,0 +1,29 @@
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# nothing refreshes in the background while testing
+os.environ['SCHEDULER'] = '0'
+
+
+@pytest.fixture
+def stub():
+    # start(handler class) -> base url of a local server, like benchmark.py's stub
+    servers = []
+
+    def start(handler):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
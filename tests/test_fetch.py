@@ -0,0 +1,97 @@
+import gzip
+import time
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+import helper
+from instrument import metrics
+
+
+class handler(BaseHTTPRequestHandler):
+    # answers every GET with the next (status, body, headers) of script,
+    # then 200 "ok"; remembers the client port of each request
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    script = []
+    ports = []
+    delay = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        type(self).ports.append(self.client_address[1])
+        time.sleep(self.delay)
+
+        status, body, headers = self.script.pop(0) if self.script else (200, b'ok', {})
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def makeHandler(script=(), delay=0):
+    return type('scripted', (handler,), {'script': list(script), 'ports': [], 'delay': delay})
+
+
+@pytest.fixture(autouse=True)
+def session(monkeypatch):
+    # a fresh pool per test, connections of other tests don't count
+    monkeypatch.setattr(helper, 'http', helper.makeSession())
+
+
+def test_connection_reuse(stub):
+    h = makeHandler()
+    url = stub(h)
+
+    for _ in range(3):
+        assert helper.fetch(url + '/api/world').content == b'ok'
+
+    assert len(h.ports) == 3
+    assert len(set(h.ports)) == 1
+
+
+def test_gzip_decoding(stub):
+    body = b'{"statistics": []}' * 100
+    h = makeHandler([(200, gzip.compress(body), {'Content-Encoding': 'gzip'})])
+    url = stub(h)
+
+    assert helper.fetch(url).content == body
+
+
+@pytest.mark.parametrize('status', [503, 429])
+def test_retry(stub, status):
+    h = makeHandler([(status, b'busy', {}), (status, b'busy', {})])
+    url = stub(h)
+
+    response = helper.fetch(url)
+    assert response.status_code == 200
+    assert len(h.ports) == 3
+
+
+def test_retries_run_out(stub):
+    h = makeHandler([(503, b'busy', {})] * 4)
+    url = stub(h)
+
+    with pytest.raises(requests.RequestException):
+        helper.fetch(url)
+    assert len(h.ports) == 4  # the first try and 3 retries
+
+
+def test_timeout(stub, monkeypatch):
+    h = makeHandler(delay=3)
+    url = stub(h)
+    monkeypatch.setitem(helper.TIMEOUTS, '127.0.0.1', (1, 0.2))
+    before = metrics.counters.get('errors_total', {}).get((('where', 'fetch'),), 0)
+
+    start = time.perf_counter()
+    with pytest.raises(requests.RequestException):
+        helper.fetch(url)
+
+    # 4 tries of 3 s without the read timeout, backoff included it's well under
+    assert time.perf_counter() - start < 8
+    assert len(h.ports) == 4
+    assert metrics.counters['errors_total'][(('where', 'fetch'),)] == before + 1
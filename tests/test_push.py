@@ -0,0 +1,129 @@
+import sys
+import json
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+from linebot.exceptions import LineBotApiError
+
+import app as site
+import push
+from helper import subscriberStore
+
+
+class lineHandler(BaseHTTPRequestHandler):
+    # a stand-in of the Messaging API multicast endpoint, answers with the
+    # next (status, headers) of script then 200, and records every request
+    script = []
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.requests.append({'path': self.path, 'key': self.headers.get('X-Line-Retry-Key'),
+                              'to': body['to'], 'messages': body['messages']})
+
+        status, headers = self.script.pop(0) if self.script else (200, {})
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{}' if status == 200 else b'{"message": "stub"}')
+
+
+@pytest.fixture
+def line(stub, tmp_path, monkeypatch):
+    # a scratch working directory with 1234 followers, and the bot's client
+    # pointed at a fresh stand-in; returns the handler class
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'files').mkdir()
+    (tmp_path / 'keys').mkdir()
+    for key in ['channel_access_token', 'channel_secret']:
+        (tmp_path / 'keys' / (key + '.txt')).write_text('test')
+
+    followers = subscriberStore()
+    for i in range(1234):
+        followers.record('U{:05d}'.format(i), True)
+    followers.record('U00007', False)
+    followers.record('U01234', True)
+    monkeypatch.setattr(push, 'subscribers', followers)
+
+    handler = type('scripted', (lineHandler,), {'script': [], 'requests': []})
+    monkeypatch.setenv('LINE_API_ENDPOINT', stub(handler))
+    monkeypatch.setattr(site, 'webhookParser', None)
+    monkeypatch.setattr(site, 'line_bot_api', None)
+    monkeypatch.setattr(push.time, 'sleep', lambda seconds: None)
+    return handler
+
+
+def runPush(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['push.py', '--run', '2020-04-01', '--rate', '1000'] + list(args))
+    push.main()
+
+
+def progress():
+    with open(push.PROGRESS, 'r') as fp:
+        return json.load(fp)
+
+
+def test_batches_of_500(line, monkeypatch):
+    runPush(monkeypatch)
+
+    assert [len(r['to']) for r in line.requests] == [500, 500, 234]
+    assert all(r['path'] == '/v2/bot/message/multicast' for r in line.requests)
+    sent = [user for r in line.requests for user in r['to']]
+    assert len(sent) == len(set(sent)) == 1234 and 'U00007' not in sent
+
+    # one message for the whole run
+    assert all(r['messages'] == line.requests[0]['messages'] for r in line.requests)
+    assert line.requests[0]['messages'][0]['type'] == 'flex'
+    assert progress() == {'run': '2020-04-01', 'done': 1234, 'total': 1234}
+
+    # a finished run is not sent again
+    runPush(monkeypatch)
+    assert len(line.requests) == 3
+
+
+def test_retry_after_429(line, monkeypatch):
+    waits = []
+    monkeypatch.setattr(push.time, 'sleep', waits.append)
+    line.script = [(200, {}), (429, {'Retry-After': '7'})]
+
+    runPush(monkeypatch)
+
+    assert [len(r['to']) for r in line.requests] == [500, 500, 500, 234]
+    # the retried batch goes out again with the same retry key
+    assert line.requests[1]['key'] == line.requests[2]['key'] != line.requests[0]['key']
+    assert line.requests[1]['to'] == line.requests[2]['to']
+    assert 7 in waits
+
+
+def test_409_already_accepted(line, monkeypatch):
+    line.script = [(200, {}), (409, {})]
+
+    runPush(monkeypatch)
+
+    # the batch LINE already has is not sent again
+    assert [len(r['to']) for r in line.requests] == [500, 500, 234]
+    assert progress()['done'] == 1234
+
+
+def test_resume_after_failure(line, monkeypatch):
+    line.script = [(200, {}), (400, {})]
+
+    with pytest.raises(LineBotApiError):
+        runPush(monkeypatch)
+    assert progress()['done'] == 500
+
+    # followers joining meanwhile wait for the next run
+    push.subscribers.record('U09999', True)
+    runPush(monkeypatch)
+
+    resumed = line.requests[2:]
+    assert [len(r['to']) for r in resumed] == [500, 234]
+    assert resumed[0]['key'] == line.requests[1]['key']
+    sent = line.requests[0]['to'] + [user for r in resumed for user in r['to']]
+    assert len(sent) == len(set(sent)) == 1234 and 'U09999' not in sent
+    assert progress()['done'] == 1234